@@ -0,0 +1,272 @@
+"""Index of the bundles of a game directory (cards map, container map, per-card info), optionally cached on disk and invalidated per bundle"""
+import hashlib
+import json
+import os
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+
+import UnityPy
+from UnityPy import Environment
+
+from asset_scanner import scan_environment
+from logs import logger as log
+
+CACHE_VERSION = 1
+# Where --lazy keeps the index when no --index-cache is given
+DEFAULT_CACHE_PATH = "asset_index.json"
+
+
+def get_file_hash(path: str) -> str:
+	sha1 = hashlib.sha1()
+	with open(path, "rb") as f:
+		for chunk in iter(lambda: f.read(1024 * 1024), b""):
+			sha1.update(chunk)
+	return sha1.hexdigest()
+
+
+def get_cab_name(path: str) -> str:
+	# Externals look like archive:/CAB-xxx/CAB-xxx, the serialized files of a bundle are named CAB-xxx
+	return os.path.basename(path).lower()
+
+
+class AssetIndexCache:
+	"""
+	Index of the bundles of a game directory, stored as JSON so that a run doesn't have to load the whole
+	environment to know where things are.
+
+	Each bundle is keyed by its path relative to src. Its entry holds the size/mtime/hash of the file, its
+	container paths (=> path_id), the cards_map if it holds it, and the names of the serialized files it
+	provides and depends on. A bundle is only opened again when its size or mtime changed and its hash
+	doesn't match anymore.
+
+	Cards are stored with the hashes of the bundles their info was built from, and are dropped as soon as
+	one of them changes.
+
+	Without a cache_path, the index is only kept in memory, and every bundle of src is opened again on each
+	run. This is why --lazy persists it to DEFAULT_CACHE_PATH when no --index-cache is given.
+	"""
+	cache_path: Optional[str]
+	src: str
+	bundles: Dict[str, dict]
+	cards: Dict[str, dict]
+
+	def __init__(self, cache_path: Optional[str], src: str):
+		self.cache_path = cache_path
+		self.src = src
+		self.bundles = {}
+		self.cards = {}
+		# Built on demand from the bundles
+		self.container = None
+		self.container_lower = None
+		self.cab_bundles = None
+		if cache_path is not None and os.path.exists(cache_path):
+			with open(cache_path, "r", encoding = "utf8") as f:
+				data = json.load(f)
+			if data.get("version") == CACHE_VERSION:
+				self.bundles = data["bundles"]
+				self.cards = data["cards"]
+
+	def save(self):
+		if self.cache_path is None:
+			return
+		data = {
+			"version": CACHE_VERSION,
+			"bundles": self.bundles,
+			"cards": self.cards,
+		}
+		tmp_path = self.cache_path + ".tmp"
+		with open(tmp_path, "wt", encoding = "utf8") as f:
+			json.dump(data, f, ensure_ascii = False)
+		os.replace(tmp_path, self.cache_path)
+
+	def refresh(self):
+		"""Re-index the bundles that changed since the last run, and drop the ones that don't exist anymore"""
+		found = {}
+		for root, dirs, files in os.walk(self.src):
+			for file_name in files:
+				file_path = os.path.join(root, file_name)
+				found[os.path.relpath(file_path, self.src).replace(os.sep, "/")] = file_path
+
+		for bundle in list(self.bundles.keys()):
+			if bundle not in found:
+				log.info("bundle removed: %s", bundle)
+				del self.bundles[bundle]
+
+		scanned = 0
+		failed = 0
+		for bundle, file_path in sorted(found.items()):
+			stat = os.stat(file_path)
+			entry = self.bundles.get(bundle)
+			if entry is not None and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime_ns:
+				continue
+			# Nothing to compare against when the index is not persisted
+			file_hash = get_file_hash(file_path) if self.cache_path is not None else "%s-%s" % (stat.st_size, stat.st_mtime_ns)
+			if entry is not None and entry["hash"] == file_hash:
+				# Touched but identical
+				entry["mtime"] = stat.st_mtime_ns
+				continue
+			log.debug("indexing bundle %s", bundle)
+			entry = self.index_bundle(file_path, stat, file_hash)
+			if entry is None:
+				# Not kept, so that the next refresh tries again (eg the file was locked by the game)
+				self.bundles.pop(bundle, None)
+				failed += 1
+				continue
+			self.bundles[bundle] = entry
+			scanned += 1
+		log.info("bundles: %s, %s indexed, %s failed", len(self.bundles), scanned, failed)
+		self.container = None
+		self.container_lower = None
+		self.cab_bundles = None
+
+	def index_bundle(self, file_path: str, stat, file_hash: str) -> Optional[dict]:
+		"""The entry of a bundle, or None if it could not be read"""
+		entry = {
+			"size": stat.st_size,
+			"mtime": stat.st_mtime_ns,
+			"hash": file_hash,
+			"cabs": [],
+			"externals": [],
+			"container": {},
+			"cards_map": None,
+		}
+		try:
+			env: Environment = UnityPy.load(file_path)
+			scan = scan_environment(env)
+			entry["container"] = {path: pptr.path_id for path, pptr in scan.container.items()}
+			if len(scan.cards_map) > 0:
+				entry["cards_map"] = scan.cards_map
+			for assets_file in env.assets:
+				entry["cabs"].append(get_cab_name(assets_file.name))
+				for external in assets_file.externals:
+					entry["externals"].append(get_cab_name(external.path))
+		except Exception as e:
+			log.warning("could not index %s: %s", file_path, e)
+			return None
+		return entry
+
+	def get_cards_map(self) -> Dict[str, str]:
+		for bundle in sorted(self.bundles.keys()):
+			cards_map = self.bundles[bundle]["cards_map"]
+			if cards_map is not None:
+				return dict(cards_map)
+		return {}
+
+	def get_container(self) -> Dict[str, list]:
+		"""container path => [bundle, path_id]"""
+		if self.container is None:
+			self.container = {}
+			for bundle in sorted(self.bundles.keys()):
+				for path, path_id in self.bundles[bundle]["container"].items():
+					self.container[path] = [bundle, path_id]
+		return self.container
+
+	def find_container_key(self, path: str) -> Optional[str]:
+		"""The container path matching path, falling back to a case-insensitive match"""
+		container = self.get_container()
+		if path in container:
+			return path
+		if self.container_lower is None:
+			self.container_lower = {}
+			for key in container.keys():
+				self.container_lower.setdefault(key.lower(), key)
+		return self.container_lower.get(path.lower())
+
+	def find_container(self, path: str) -> Optional[list]:
+		key = self.find_container_key(path)
+		return None if key is None else self.get_container()[key]
+
+	def get_bundles(self, paths: Iterable[str]) -> List[str]:
+		"""The bundles holding the given container paths, and the bundles they depend on"""
+		bundles = []
+		for path in paths:
+			location = self.find_container(path)
+			if location is not None:
+				bundles.append(location[0])
+		return self.get_dependencies(bundles)
+
+	def get_dependencies(self, bundles: Iterable[str]) -> List[str]:
+		"""The given bundles, and the bundles they depend on"""
+		if self.cab_bundles is None:
+			self.cab_bundles = {}
+			for bundle, entry in self.bundles.items():
+				for cab in entry["cabs"]:
+					self.cab_bundles[cab] = bundle
+		pending = list(bundles)
+		bundles = set()
+		while pending:
+			bundle = pending.pop()
+			if bundle in bundles:
+				continue
+			bundles.add(bundle)
+			for external in self.bundles[bundle]["externals"]:
+				# Built-in resources are not part of the game directory
+				if external in self.cab_bundles:
+					pending.append(self.cab_bundles[external])
+		return sorted(bundles)
+
+	def open_bundles(self, bundles: List[str]) -> Environment:
+		return UnityPy.load(*[os.path.join(self.src, bundle) for bundle in bundles])
+
+	def get_card(self, card_id: str, prefab_id: str) -> Optional[dict]:
+		"""The cached entry of a card, or None if it is missing or one of its bundles changed"""
+		entry = self.cards.get(card_id)
+		if entry is None or entry["prefab"] != prefab_id:
+			return None
+		for bundle, file_hash in entry["bundles"].items():
+			if bundle not in self.bundles or self.bundles[bundle]["hash"] != file_hash:
+				return None
+		return entry
+
+	def set_card(self, card_id: str, prefab_id: str, paths: Iterable[str], info):
+		"""Store the info of a card, built from the given container paths (and their dependencies)"""
+		self.cards[card_id] = {
+			"prefab": prefab_id,
+			"bundles": {bundle: self.bundles[bundle]["hash"] for bundle in self.get_bundles(paths)},
+			"info": info,
+		}
+
+
+class LazyContainer:
+	"""
+	Read-only mapping of container path => object, like env.container, that only opens the bundle holding a path
+	(and its dependencies) when the path is accessed. Only the last max_open environments are kept, the older
+	ones are released once nothing references their objects anymore.
+	"""
+	cache: AssetIndexCache
+	max_open: int
+
+	def __init__(self, cache: AssetIndexCache, max_open: int = 8):
+		self.cache = cache
+		self.max_open = max_open
+		# bundle => container of the environment opened for it
+		self.opened = OrderedDict()
+		self.open_count = 0
+
+	def __contains__(self, path: str) -> bool:
+		return self.cache.find_container_key(path) is not None
+
+	def __getitem__(self, path: str):
+		key = self.cache.find_container_key(path)
+		if key is None:
+			raise KeyError(path)
+		bundle = self.cache.get_container()[key][0]
+		return self.get_bundle_container(bundle)[key]
+
+	def get(self, path: str, default = None):
+		return self[path] if path in self else default
+
+	def get_bundle(self, path: str) -> Optional[str]:
+		location = self.cache.find_container(path)
+		return None if location is None else location[0]
+
+	def get_bundle_container(self, bundle: str) -> dict:
+		if bundle in self.opened:
+			self.opened.move_to_end(bundle)
+			return self.opened[bundle]
+		env: Environment = self.cache.open_bundles(self.cache.get_dependencies([bundle]))
+		self.open_count += 1
+		self.opened[bundle] = env.container
+		while len(self.opened) > self.max_open:
+			self.opened.popitem(last = False)
+		return self.opened[bundle]
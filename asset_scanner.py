@@ -0,0 +1,136 @@
+"""Single traversal of a UnityPy environment, shared by generate_card_textures.py and generate_audio_mapping.py"""
+import struct
+from typing import Callable, Dict, List, Optional, cast
+
+from UnityPy import Environment
+from UnityPy.enums import BuildTarget, ClassIDType
+from UnityPy.classes import PPtr, MonoBehaviour, AssetBundle, NamedObject
+
+from card_filter import CardFilter
+from logs import logger as log
+
+
+class ScanResult:
+	# cardid => prefab id, from the cards_map MonoBehaviour
+	cards_map: Dict[str, str]
+	# container path => asset, from all the AssetBundles. This is where the textures and the audio clips are found
+	container: Dict[str, PPtr]
+
+	def __init__(self):
+		self.cards_map = None
+		self.container = {}
+
+
+class EnvironmentScanner:
+	"""Walks env.objects once, and hands each object to the collectors registered for its type"""
+	collectors: Dict[ClassIDType, List[Callable]]
+
+	def __init__(self):
+		self.collectors = {}
+
+	def register(self, class_id: ClassIDType, collector: Callable):
+		self.collectors.setdefault(class_id, []).append(collector)
+
+	def scan(self, env: Environment):
+		for obj in env.objects:
+			collectors = self.collectors.get(obj.type)
+			if collectors is None:
+				continue
+			for collector in collectors:
+				collector(obj)
+
+
+def scan_environment(env: Environment, cards_list: Optional[CardFilter] = None, cards_map: bool = True) -> ScanResult:
+	"""Without cards_map, only the container is collected (the --jobs workers get the cards map from the main process)"""
+	result = ScanResult()
+	scanner = EnvironmentScanner()
+	if cards_map:
+		scanner.register(ClassIDType.MonoBehaviour, lambda obj: collect_cards_map(obj, result, cards_list))
+	scanner.register(ClassIDType.AssetBundle, lambda obj: collect_container(obj, result))
+	scanner.scan(env)
+	# Empty dict if no cards_map found
+	if result.cards_map is None:
+		result.cards_map = {}
+	return result
+
+
+def collect_cards_map(obj, result: ScanResult, cards_list: Optional[CardFilter] = None):
+	# Only the first cards_map is used
+	if result.cards_map is not None:
+		return
+	# Don't decode every MonoBehaviour just to check its name
+	if read_object_name(obj) != "cards_map":
+		return
+	dataM: MonoBehaviour = cast(MonoBehaviour, obj.read())
+	result.cards_map = parse_cards_map(dataM, cards_list)
+
+
+def parse_cards_map(dataM: MonoBehaviour, cards_list: Optional[CardFilter] = None) -> Dict[str, str]:
+	tree = dataM.map
+	keys = tree.keys
+	values = tree.values
+	log.info("keys: %s", len(keys))
+	log.info("values: %s", len(values))
+	# Build a dictionary of key => prefabid
+	cards_map = {}
+	for cardid, value in zip(keys, values):
+		if cards_list and cardid not in cards_list:
+			# print("skipping build_cards_map %s" % cardid)
+			continue
+		# Only keep the id of the prefab, which means what is after prefab:
+		asset_id = value.split("prefab:")[1]
+		cards_map[cardid] = asset_id
+	return cards_map
+
+
+def collect_container(obj, result: ScanResult):
+	data = cast(AssetBundle, obj.read())
+	for path, asset in data.m_Container:
+		result.container[path] = asset.asset
+
+
+# m_GameObject (PPtr: m_FileID, m_PathID), m_Enabled (a byte, aligned to 4), m_Script (PPtr), then m_Name. m_PathID is
+# 64-bit since version 14 of the serialized files
+MONO_BEHAVIOUR_NAME_OFFSET = 12 + 4 + 12
+MAX_NAME_LENGTH = 256
+
+
+def read_object_name(obj) -> Optional[str]:
+	"""
+	Read m_Name from the object data, without decoding the whole object when possible. obj.peek_name() reads the
+	first field as m_Name, which is only right for the NamedObject types (Texture2D, AudioClip...): a MonoBehaviour
+	starts with its m_GameObject / m_Enabled / m_Script header, and a GameObject with its components.
+	"""
+	try:
+		if obj.platform == BuildTarget.NoTarget:
+			# The editor layout has more fields before m_Name
+			name = None
+		elif obj.type == ClassIDType.MonoBehaviour:
+			name = read_mono_behaviour_name(obj)
+		elif issubclass(obj.get_class(), NamedObject):
+			name = obj.peek_name()
+		else:
+			name = None
+	except Exception:
+		name = None
+	if name is not None:
+		return name
+	return obj.read_typetree().get("m_Name")
+
+
+def read_mono_behaviour_name(obj) -> Optional[str]:
+	# The header is read as bytes, the typetree of a MonoBehaviour can be large (eg the DBF records)
+	obj.reset()
+	data = bytes(obj.reader.read_bytes(min(obj.byte_size, MONO_BEHAVIOUR_NAME_OFFSET + 4 + MAX_NAME_LENGTH)))
+	return parse_mono_behaviour_name(data, obj.reader.endian, obj.version2)
+
+
+def parse_mono_behaviour_name(data: bytes, endian: str = "<", version: int = 22) -> Optional[str]:
+	"""m_Name from the start of the data of a MonoBehaviour, or None if it doesn't look like one"""
+	offset = MONO_BEHAVIOUR_NAME_OFFSET if version >= 14 else 8 + 4 + 8
+	if len(data) < offset + 4:
+		return None
+	(length,) = struct.unpack_from(endian + "i", data, offset)
+	if length < 0 or length > MAX_NAME_LENGTH or offset + 4 + length > len(data):
+		return None
+	return data[offset + 4:offset + 4 + length].decode("utf8", "surrogateescape")
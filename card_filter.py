@@ -0,0 +1,47 @@
+"""Selection of the cards to process, as given by --cards-list"""
+import fnmatch
+import re
+from typing import Iterable
+
+
+class CardFilter:
+	"""
+	Card ids to include. Each line is either a card id, or a glob pattern (BG*, HERO_*, CORE_?X1_*).
+	Empty lines and lines starting with # are ignored.
+
+	Card ids are looked up in a set, and all the patterns are merged in a single regex, so checking a card
+	doesn't depend on the size of the list.
+	"""
+	card_ids: set
+	patterns: list
+
+	def __init__(self, lines: Iterable[str]):
+		self.card_ids = set()
+		self.patterns = []
+		for line in lines:
+			line = line.strip()
+			if len(line) == 0 or line.startswith("#"):
+				continue
+			if any(c in line for c in "*?["):
+				self.patterns.append(line)
+			else:
+				self.card_ids.add(line)
+		self.regex = None
+		if len(self.patterns) > 0:
+			self.regex = re.compile("|".join(fnmatch.translate(pattern) for pattern in self.patterns))
+
+	@classmethod
+	def from_file(cls, path: str) -> "CardFilter":
+		with open(path, "r") as f:
+			return cls(f.read().splitlines())
+
+	def __contains__(self, card_id: str) -> bool:
+		if card_id in self.card_ids:
+			return True
+		return self.regex is not None and self.regex.match(card_id) is not None
+
+	def __len__(self) -> int:
+		return len(self.card_ids) + len(self.patterns)
+
+	def __repr__(self) -> str:
+		return "%s card ids, %s patterns" % (len(self.card_ids), len(self.patterns))
@@ -0,0 +1,68 @@
+"""Journal of the cards handled by the long card loops, so that a run that crashed can resume where it stopped"""
+import json
+import os
+from typing import Optional
+
+from logs import logger as log
+
+
+class CheckpointJournal:
+	"""
+	Append-only JSONL file, with one {"card", "stage", "key", "result"} line per finished card and stage (eg the
+	info of the card, then its rendering). key is what the result was built from (the prefab id), and a card is
+	only reused if it didn't change.
+
+	Each line is flushed as soon as it is written, so the journal survives the process dying in the middle of
+	the loop (including a segfault in UnityPy). A line cut short by the crash is dropped.
+
+	Without resume, the journal of the previous run is discarded. It is removed once the run is complete.
+	"""
+	path: str
+	entries: dict
+
+	def __init__(self, path: str, resume: bool = False):
+		self.path = path
+		self.entries = {}
+		if resume and os.path.exists(path):
+			with open(path, "rb") as f:
+				data = f.read()
+			# Drop the line cut short by the crash, so that the next one isn't appended to it
+			complete = data[:data.rfind(b"\n") + 1]
+			if len(complete) < len(data):
+				os.truncate(path, len(complete))
+			for line in complete.splitlines():
+				try:
+					entry = json.loads(line)
+				except ValueError:
+					continue
+				self.entries[(entry.get("stage", "info"), entry["card"])] = entry
+			log.info("checkpoint: %s entries from the previous run in %s", len(self.entries), path)
+		self.file = open(path, "a" if resume else "w", encoding = "utf8")
+
+	def get(self, card_id: str, key: str, stage: str = "info") -> Optional[dict]:
+		"""The entry of a card done in the previous run, its result can be None"""
+		entry = self.entries.get((stage, card_id))
+		if entry is None or entry["key"] != key:
+			return None
+		return entry
+
+	def record(self, card_id: str, key: str, result, stage: str = "info"):
+		entry = {"card": card_id, "stage": stage, "key": key, "result": result}
+		self.entries[(stage, card_id)] = entry
+		self.file.write(json.dumps(entry, ensure_ascii = False) + "\n")
+		self.file.flush()
+
+	def close(self):
+		self.file.close()
+
+	def finish(self):
+		"""The run is complete, nothing to resume anymore"""
+		self.close()
+		os.remove(self.path)
+
+
+def open_journal(path: Optional[str], default_path: str, resume: bool = False) -> Optional[CheckpointJournal]:
+	"""The journal is only kept when asked for (a path, or resume), so that a plain run doesn't discard the journal of a crashed one"""
+	if path is None and not resume:
+		return None
+	return CheckpointJournal(path or default_path, resume)
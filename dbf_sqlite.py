@@ -0,0 +1,104 @@
+"""SQLite export of the DBF tables, written by extract_ref_objects.py --sqlite"""
+import json
+import sqlite3
+from typing import Dict, List, Optional
+
+from dbf_store import FOREIGN_KEY
+
+
+def get_column_type(value) -> Optional[str]:
+	# bool is an int too, but the DBF only has 0/1 ints anyway
+	if isinstance(value, int):
+		return "INTEGER"
+	if isinstance(value, float):
+		return "REAL"
+	if value is None:
+		return None
+	# Strings, and the localized strings / lists, which are stored as JSON
+	return "TEXT"
+
+
+def get_column_value(value):
+	if isinstance(value, (dict, list)):
+		return json.dumps(value, ensure_ascii = False)
+	return value
+
+
+def quote(name: str) -> str:
+	return '"%s"' % name.replace('"', '""')
+
+
+class DbfSqliteWriter:
+	"""
+	One SQL table per DBF, with a column per record field and a locale column for the {name}-{loc} variants.
+	The schema is inferred from the records, and grows when a later file has more fields. Writing a table
+	again for the same locale replaces its rows, like the JSON files are overwritten.
+
+	m_ID, the locale and the m_*Id / m_*_ID fields are indexed, so joins like
+	CARD_SET.m_ID = BOOSTER_CARD_SET.m_cardSetId don't scan the tables.
+	"""
+	db_path: str
+	# table => column => SQL type
+	columns: Dict[str, Dict[str, Optional[str]]]
+
+	def __init__(self, db_path: str):
+		self.db_path = db_path
+		self.connection = sqlite3.connect(db_path)
+		self.columns = {}
+		for (table,) in self.connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'").fetchall():
+			self.columns[table] = {
+				row[1]: row[2] for row in self.connection.execute("PRAGMA table_info(%s)" % quote(table)).fetchall()
+			}
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+		return False
+
+	def write_table(self, name: str, locale: Optional[str], records: List[dict]):
+		columns = {}
+		for record in records:
+			for field, value in record.items():
+				if columns.get(field) is None:
+					columns[field] = get_column_type(value)
+				elif columns[field] == "INTEGER" and isinstance(value, float):
+					columns[field] = "REAL"
+
+		# A single transaction per table, so that the rows are not committed one at a time
+		with self.connection:
+			self.update_schema(name, columns)
+			self.connection.execute("DELETE FROM %s WHERE locale IS ?" % quote(name), (locale,))
+			if len(records) > 0:
+				fields = list(columns.keys())
+				sql = "INSERT INTO %s (locale, %s) VALUES (?, %s)" % (
+					quote(name), ", ".join(quote(field) for field in fields), ", ".join("?" for _ in fields)
+				)
+				self.connection.executemany(
+					sql,
+					([locale] + [get_column_value(record.get(field)) for field in fields] for record in records)
+				)
+			self.update_indexes(name)
+
+	def update_schema(self, name: str, columns: Dict[str, Optional[str]]):
+		existing = self.columns.get(name)
+		if existing is None:
+			definitions = ["locale TEXT"] + ["%s %s" % (quote(field), sql_type or "") for field, sql_type in columns.items()]
+			self.connection.execute("CREATE TABLE %s (%s)" % (quote(name), ", ".join(definitions)))
+			self.columns[name] = dict(columns, locale = "TEXT")
+			return
+		for field, sql_type in columns.items():
+			if field not in existing:
+				self.connection.execute("ALTER TABLE %s ADD COLUMN %s %s" % (quote(name), quote(field), sql_type or ""))
+				existing[field] = sql_type
+
+	def update_indexes(self, name: str):
+		indexed = ["locale"] + [field for field in self.columns[name] if field == "m_ID" or FOREIGN_KEY.match(field)]
+		for field in indexed:
+			self.connection.execute("CREATE INDEX IF NOT EXISTS %s ON %s (%s)" % (
+				quote("%s_%s" % (name, field)), quote(name), quote(field)
+			))
+
+	def close(self):
+		self.connection.close()
@@ -0,0 +1,287 @@
+"""Indexed, lazy access to the DBF tables written by extract_ref_objects.py in ref/objects"""
+import json
+import mmap
+import os
+import re
+from typing import Dict, Iterator, List, Optional
+
+INDEX_VERSION = 2
+
+# Integer fields that reference another table, eg m_subsetId, m_cardSetId (but not m_ID itself)
+FOREIGN_KEY = re.compile(r"^m_\w+(Id|_ID)$")
+
+
+class DbfTable:
+	"""
+	One table file, memory-mapped. Only the byte ranges of its records are known up front (from the sidecar
+	index), and a record is only parsed when it is returned.
+	"""
+	name: str
+	path: str
+	# Byte range of each record in the file, in file order
+	offsets: List[list]
+	# m_ID => position in offsets
+	ids: Dict[int, int]
+	# field => value => positions in offsets
+	foreign_keys: Dict[str, Dict[int, List[int]]]
+
+	def __init__(self, name: str, path: str, index_path: str, strings: Optional[Dict[int, dict]] = None):
+		self.name = name
+		self.path = path
+		# m_ID => field => value, for a locale stored as an overlay of the base table
+		self.strings = strings or {}
+		self.file = open(path, "rb")
+		# mmap doesn't support empty files
+		stat = os.fstat(self.file.fileno())
+		self.data = mmap.mmap(self.file.fileno(), 0, access = mmap.ACCESS_READ) if stat.st_size > 0 else b""
+		index = load_index(index_path, stat)
+		if index is None:
+			index = build_index(self.data, path.endswith(".ndjson"))
+			index["size"] = stat.st_size
+			index["mtime"] = stat.st_mtime_ns
+			save_index(index_path, index)
+		self.offsets = index["offsets"]
+		self.ids = {int(record_id): position for record_id, position in index["ids"].items()}
+		self.foreign_keys = {
+			field: {int(value): positions for value, positions in values.items()}
+			for field, values in index["foreign_keys"].items()
+		}
+
+	def __len__(self) -> int:
+		return len(self.offsets)
+
+	def read(self, position: int) -> dict:
+		start, end = self.offsets[position]
+		record = json.loads(self.data[start:end])
+		if record.get("m_ID") in self.strings:
+			record.update(self.strings[record["m_ID"]])
+		return record
+
+	def get(self, record_id: int) -> Optional[dict]:
+		position = self.ids.get(record_id)
+		return None if position is None else self.read(position)
+
+	def find(self, field: str, value: int) -> Iterator[dict]:
+		if field not in self.foreign_keys:
+			raise KeyError("%s is not indexed in %s" % (field, self.name))
+		for position in self.foreign_keys[field].get(value, []):
+			yield self.read(position)
+
+	def records(self) -> Iterator[dict]:
+		for position in range(len(self.offsets)):
+			yield self.read(position)
+
+	def close(self):
+		if isinstance(self.data, mmap.mmap):
+			self.data.close()
+		self.file.close()
+
+
+class DbfStore:
+	"""
+	Point lookups over the ref/objects tables, without parsing whole files:
+
+		with DbfStore("ref/objects") as store:
+			card_set = store.get("CARD_SET", 1001)
+			subset_cards = list(store.find("SUBSET_CARD", "m_subsetId", 1312))
+
+	Each table gets a sidecar index (record byte ranges, m_ID and the m_*Id fields) in index_dir, built on
+	first access and rebuilt when the table file changes. locale picks the {name}-{locale} files, the
+	default is the unsuffixed (enUS) ones. When a locale only has a {name}-{locale}.strings overlay (see
+	extract_ref_objects.py --locale-overlays), records come from the base table with the overlay applied.
+	"""
+	root: str
+	locale: Optional[str]
+	index_dir: str
+
+	def __init__(self, root: str = "ref/objects", locale: Optional[str] = None, index_dir: Optional[str] = None):
+		self.root = root
+		self.locale = locale
+		self.index_dir = index_dir if index_dir is not None else os.path.join(root, ".index")
+		self.opened: Dict[str, DbfTable] = {}
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+		return False
+
+	def tables(self) -> List[str]:
+		names = set()
+		for file_name in os.listdir(self.root):
+			name, ext = os.path.splitext(file_name)
+			if ext not in (".json", ".ndjson"):
+				continue
+			# Locales without a full copy fall back to the base table
+			if "-" not in name:
+				names.add(name)
+			elif self.locale is not None and name.endswith("-" + self.locale):
+				names.add(name[:-len(self.locale) - 1])
+		return sorted(names)
+
+	def table(self, name: str) -> DbfTable:
+		if name not in self.opened:
+			strings = None
+			path = find_table_file(self.root, name, self.locale)
+			if path is None and self.locale is not None:
+				path = find_table_file(self.root, name)
+				strings = load_locale_overlay(self.root, name, self.locale)
+			if path is None:
+				raise KeyError("No table %s in %s" % (name, self.root))
+			os.makedirs(self.index_dir, exist_ok = True)
+			index_path = os.path.join(self.index_dir, os.path.basename(path) + ".index.json")
+			self.opened[name] = DbfTable(name, path, index_path, strings)
+		return self.opened[name]
+
+	def get(self, table: str, record_id: int) -> Optional[dict]:
+		return self.table(table).get(record_id)
+
+	def find(self, table: str, field: str, value: int) -> Iterator[dict]:
+		return self.table(table).find(field, value)
+
+	def records(self, table: str) -> Iterator[dict]:
+		return self.table(table).records()
+
+	def close(self):
+		for table in self.opened.values():
+			table.close()
+		self.opened = {}
+
+
+def find_table_file(root: str, name: str, locale: Optional[str] = None) -> Optional[str]:
+	file_name = name if locale is None else "%s-%s" % (name, locale)
+	for ext in (".json", ".ndjson"):
+		path = os.path.join(root, file_name + ext)
+		if os.path.exists(path):
+			return path
+	return None
+
+
+def get_locale_overlay_name(name: str, locale: str) -> str:
+	return "%s-%s.strings" % (name, locale)
+
+
+def make_locale_overlay(base_records: List[dict], records: List[dict]) -> Optional[Dict[int, dict]]:
+	"""
+	The string fields of records that differ from base_records, as m_ID => field => value. None when the
+	locale differs in anything else (other records, other ids or numbers), and needs a full copy.
+	"""
+	if len(base_records) != len(records):
+		return None
+	strings = {}
+	for base, record in zip(base_records, records):
+		if "m_ID" not in record or record.get("m_ID") != base.get("m_ID") or record.keys() != base.keys():
+			return None
+		for field, value in record.items():
+			if value == base[field]:
+				continue
+			# Plain strings, and the localized strings ({"m_locValues": [...], "m_locId": ...})
+			if not isinstance(value, (str, dict)):
+				return None
+			strings.setdefault(record["m_ID"], {})[field] = value
+	return strings
+
+
+def apply_locale_overlay(records: List[dict], strings: Dict[int, dict]) -> List[dict]:
+	return [dict(record, **strings[record["m_ID"]]) if record.get("m_ID") in strings else record for record in records]
+
+
+def load_locale_overlay(root: str, name: str, locale: str) -> Optional[Dict[int, dict]]:
+	path = os.path.join(root, get_locale_overlay_name(name, locale) + ".json")
+	if not os.path.exists(path):
+		return None
+	with open(path, "r", encoding = "utf8") as f:
+		overlay = json.load(f)
+	return {int(record_id): fields for record_id, fields in overlay["Strings"].items()}
+
+
+def load_table(root: str, name: str, locale: Optional[str] = None) -> Optional[dict]:
+	"""
+	The whole table (Unity envelope and Records) for a locale, whether it was written as a full copy or as an
+	overlay of the base table
+	"""
+	path = find_table_file(root, name, locale)
+	strings = None
+	if path is None and locale is not None:
+		path = find_table_file(root, name)
+		strings = load_locale_overlay(root, name, locale)
+	if path is None:
+		return None
+	with open(path, "r", encoding = "utf8") as f:
+		if path.endswith(".ndjson"):
+			lines = [json.loads(line) for line in f if line.strip()]
+			tree = dict(lines[0], Records = lines[1:])
+		else:
+			tree = json.load(f)
+	if strings and "Records" in tree:
+		tree["Records"] = apply_locale_overlay(tree["Records"], strings)
+	return tree
+
+
+def load_index(index_path: str, stat) -> Optional[dict]:
+	if not os.path.exists(index_path):
+		return None
+	with open(index_path, "r", encoding = "utf8") as f:
+		index = json.load(f)
+	if index.get("version") != INDEX_VERSION or index["size"] != stat.st_size or index["mtime"] != stat.st_mtime_ns:
+		return None
+	return index
+
+
+def save_index(index_path: str, index: dict):
+	tmp_path = index_path + ".tmp"
+	with open(tmp_path, "wt", encoding = "utf8") as f:
+		json.dump(index, f)
+	os.replace(tmp_path, index_path)
+
+
+def build_index(data, is_ndjson: bool) -> dict:
+	"""Parse the table once to find the byte range of each record, and index m_ID and the m_*Id fields"""
+	offsets = []
+	records = []
+	if is_ndjson:
+		# The first line is the envelope, then one record per line
+		start = data.find(b"\n") + 1 if len(data) > 0 else 0
+		while start < len(data):
+			end = data.find(b"\n", start)
+			end = len(data) if end < 0 else end
+			if end > start:
+				offsets.append([start, end])
+				records.append(json.loads(data[start:end]))
+			start = end + 1
+	else:
+		text = bytes(data).decode("utf8")
+		records_start = re.search(r'"Records"\s*:\s*\[', text)
+		if records_start is not None:
+			decoder = json.JSONDecoder()
+			whitespace = re.compile(r"[\s,]*")
+			position = records_start.end()
+			# Offsets are in bytes, while the decoder works on characters
+			byte_position = len(text[:position].encode("utf8"))
+			while True:
+				skipped = whitespace.match(text, position).end()
+				byte_position += len(text[position:skipped].encode("utf8"))
+				position = skipped
+				if text[position] == "]":
+					break
+				record, end = decoder.raw_decode(text, position)
+				byte_end = byte_position + len(text[position:end].encode("utf8"))
+				offsets.append([byte_position, byte_end])
+				records.append(record)
+				position, byte_position = end, byte_end
+
+	ids = {}
+	foreign_keys = {}
+	for position, record in enumerate(records):
+		if "m_ID" in record:
+			ids[record["m_ID"]] = position
+		for field, value in record.items():
+			if isinstance(value, int) and FOREIGN_KEY.match(field):
+				foreign_keys.setdefault(field, {}).setdefault(value, []).append(position)
+	return {
+		"version": INDEX_VERSION,
+		"offsets": offsets,
+		"ids": ids,
+		"foreign_keys": foreign_keys,
+	}
@@ -2,14 +2,23 @@
 import json
 import os
 import sys
-import datetime
+import fnmatch
+import hashlib
+import io
+import shutil
+import threading
+import uuid
 from argparse import ArgumentParser
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
 
 import UnityPy
 from pydub import AudioSegment
 from UnityPy.enums import ClassIDType
 
+import logs
+from logs import logger as log
+
 locales = [
 	'enUS',
 	'deDE',
@@ -27,70 +36,256 @@ locales = [
 	'zhTW',
 ]
 
-import sys
-
-# save the original print function
-original_print = print
-
-def print_with_timestamp(*args, **kwargs):
-    original_print(f"[{datetime.datetime.now()}]", *args, **kwargs)
-
-# replace print function with the new one
-print = print_with_timestamp
-
-class Logger(object):
-    def __init__(self, logFile):
-        self.terminal = sys.stdout
-        self.log = open(logFile, "a")
-   
-    def write(self, message):
-        self.terminal.write(message)
-        self.log.write(message)  
-
-    def flush(self):
-        # this flush method is needed for python 3 compatibility.
-        # this handles the flush command by doing nothing.
-        # you might want to specify some extra behavior here.
-        pass    
-
-sys.stdout = Logger("extract_audio.log")
 outDir = "out"
 
 # ./generate_audio_mapping.py /e/Games/Hearthstone/Data/Win
 def main():
-	os.makedirs(os.path.dirname(f"{outDir}/sounds_wav/"), exist_ok=True)
-	os.makedirs(os.path.dirname(f"{outDir}/sounds_wav/common/"), exist_ok=True)
-	os.makedirs(os.path.dirname(f"{outDir}/sounds/common/"), exist_ok=True)
-	for loc in locales:
-		os.makedirs(os.path.dirname(f"{outDir}/sounds/{loc}/"), exist_ok=True)
-		os.makedirs(os.path.dirname(f"{outDir}/sounds_wav/{loc}/"), exist_ok=True)
-		
 	p = ArgumentParser()
 	p.add_argument("src")
+	p.add_argument("--jobs", type=int, default=os.cpu_count(), help="Number of OGG encodes running at the same time")
+	p.add_argument("--keep-wav", action="store_true", help="Also write the WAV samples to out/sounds_wav")
+	p.add_argument("--locales", nargs="+", choices=locales + ["common"], help="Only extract the clips of these locales")
+	p.add_argument("--bundles", nargs="+", help="Only open the bundles matching these patterns (eg *_frfr-*)")
+	p.add_argument(
+		"--bundle-manifest", default=f"{outDir}/audio_bundles.json",
+		help="Where the list of sound bundles (and whether they hold audio clips) is kept between runs"
+	)
+	logs.add_logging_arguments(p)
 	args = p.parse_args(sys.argv[1:])
-	for root, dirs, files in os.walk(args.src):
-		for file_name in files:
-			if "sound" not in file_name.lower() and "audio" not in file_name.lower():
-				# print("skipping %s" % file_name)
-				continue
+	logs.setup_logging("extract_audio", args.verbose, timestamps = True, file_mode = "a")
+
+	os.makedirs(os.path.dirname(f"{outDir}/sounds/common/"), exist_ok=True)
+	for loc in locales:
+		os.makedirs(os.path.dirname(f"{outDir}/sounds/{loc}/"), exist_ok=True)
+	if args.keep_wav:
+		os.makedirs(os.path.dirname(f"{outDir}/sounds_wav/common/"), exist_ok=True)
+		for loc in locales:
+			os.makedirs(os.path.dirname(f"{outDir}/sounds_wav/{loc}/"), exist_ok=True)
 
-			# generate file_path
-			file_path = os.path.join(root, file_name)
+	manifest = AudioManifest(f"{outDir}/sounds/manifest.json")
+	encoder = OggEncoder(args.jobs, manifest, args.keep_wav)
+	bundles = BundleManifest(args.bundle_manifest, args.src)
+	bundles.refresh()
+	for bundle, entry in bundles.select(args.locales, args.bundles):
+		# generate file_path
+		file_path = os.path.join(args.src, bundle)
+		with logs.timed("bundle", bundle = bundle, locale = entry["locale"]) as event:
 			env = UnityPy.load(file_path)
-			print("handling %s" % file_path)
+			log.info("handling %s", file_path)
+			event["clips"] = extract_assets(env, entry["locale"], encoder, args.locales)
+		entry["has_audio"] = event["clips"] > 0
 
-			current_loc = 'common'
-			for loc in locales:
-				if ("_" + loc.lower() + "-") in file_path.lower():
-					current_loc = loc
-					# print("current_loc %s" % current_loc)
-					# print("file path %s" % file_path)
+	encoder.close()
+	manifest.save()
+	bundles.save()
 
-			extract_assets(env, current_loc)
 
+def get_bundle_locale(file_path):
+	current_loc = 'common'
+	for loc in locales:
+		if ("_" + loc.lower() + "-") in file_path.lower():
+			current_loc = loc
+	return current_loc
+
+
+class BundleManifest:
+	"""
+	The sound bundles of the game directory (path, size, mtime, locale), and whether they hold any AudioClip.
+	It is kept between runs, so that only the files that changed are looked at again, and the bundles known
+	to have no audio are not opened at all.
+	"""
+	def __init__(self, path, src):
+		self.path = path
+		self.src = src
+		# path relative to src => entry
+		self.bundles = {}
+		if os.path.exists(path):
+			with open(path, "r") as f:
+				self.bundles = json.load(f)
+
+	def refresh(self):
+		found = {}
+		for root, dirs, files in os.walk(self.src):
+			for file_name in files:
+				if "sound" not in file_name.lower() and "audio" not in file_name.lower():
+					# print("skipping %s" % file_name)
+					continue
+				file_path = os.path.join(root, file_name)
+				stat = os.stat(file_path)
+				bundle = os.path.relpath(file_path, self.src).replace(os.sep, "/")
+				entry = self.bundles.get(bundle)
+				if entry is None or entry["size"] != stat.st_size or entry["mtime"] != stat.st_mtime_ns:
+					# Whether it holds audio is only known once it has been opened
+					entry = {
+						"size": stat.st_size,
+						"mtime": stat.st_mtime_ns,
+						"locale": get_bundle_locale(file_path),
+						"has_audio": None,
+					}
+				found[bundle] = entry
+		self.bundles = found
+		log.info("sound bundles: %s, %s without audio", len(found), sum(1 for entry in found.values() if entry["has_audio"] is False))
+
+	def select(self, selected_locales = None, patterns = None):
+		"""The (bundle, entry) to open, in path order"""
+		selected = []
+		for bundle, entry in sorted(self.bundles.items()):
+			if entry["has_audio"] is False:
+				continue
+			# The clips of the common bundles can still be routed to a locale by their path
+			if selected_locales and entry["locale"] != "common" and entry["locale"] not in selected_locales:
+				continue
+			if patterns and not any(fnmatch.fnmatch(bundle.lower(), pattern.lower()) for pattern in patterns):
+				continue
+			selected.append((bundle, entry))
+		return selected
 
+	def save(self):
+		tmp_path = self.path + ".tmp"
+		with open(tmp_path, "w") as f:
+			json.dump(self.bundles, f, indent = "\t", sort_keys = True)
+		os.replace(tmp_path, self.path)
 
-def extract_assets(env, current_loc):
+
+class AudioManifest:
+	"""
+	The sha1 of the sample of each clip ({loc}/{name} => hash), and the OGG file each sample was first encoded
+	to (hash => file). The same sample is found in several bundles and locales (mostly the common SFX), and is
+	only encoded once: the other clips are links to that file.
+	"""
+	def __init__(self, path):
+		self.path = path
+		self.clips = {}
+		self.files = {}
+		if os.path.exists(path):
+			with open(path, "r") as f:
+				data = json.load(f)
+			self.clips = data["clips"]
+			self.files = data["files"]
+
+	def get_file(self, sample_hash):
+		"""The OGG file already encoded for this sample, if it is still there"""
+		file_name = self.files.get(sample_hash)
+		if file_name is not None and os.path.exists(file_name):
+			return file_name
+		return None
+
+	def save(self):
+		tmp_path = self.path + ".tmp"
+		with open(tmp_path, "w") as f:
+			json.dump({"clips": self.clips, "files": self.files}, f, indent = "\t", sort_keys = True)
+		os.replace(tmp_path, self.path)
+
+
+class OggEncoder:
+	"""
+	Encodes the samples on a pool of threads: pydub runs ffmpeg in a subprocess, so the threads only wait for it
+	while the main thread keeps extracting samples. At most max_pending samples are queued, and submit blocks
+	when the encoders fall behind, so that memory doesn't grow with the number of clips.
+	"""
+	def __init__(self, jobs, manifest, keep_wav = False, max_pending = None):
+		self.executor = ThreadPoolExecutor(jobs)
+		self.manifest = manifest
+		self.keep_wav = keep_wav
+		self.slots = threading.BoundedSemaphore(max_pending or jobs * 2)
+		self.lock = threading.Lock()
+		# hash => (future, ogg file) of the encode of this sample
+		self.encoding = {}
+		# The OGG files being encoded or waiting to be linked, which don't exist on disk yet
+		self.in_flight = set()
+		self.succeeded = 0
+		self.linked = 0
+		self.failed = []
+
+	def submit(self, clip, wav_file_name, ogg_file_name, data):
+		# Like for a file already on disk, the first sample submitted for a name is the one kept
+		with self.lock:
+			if ogg_file_name in self.in_flight:
+				return
+		sample_hash = hashlib.sha1(data).hexdigest()
+		self.manifest.clips[clip] = sample_hash
+		if self.keep_wav and not os.path.exists(wav_file_name):
+			with open(wav_file_name, "wb") as f:
+				f.write(data)
+		# The WAV files are optional, the OGG is what tells whether the sample was already extracted
+		if os.path.exists(ogg_file_name):
+			self.manifest.files.setdefault(sample_hash, ogg_file_name)
+			return
+
+		if sample_hash in self.encoding:
+			future, source_file_name = self.encoding[sample_hash]
+			with self.lock:
+				self.in_flight.add(ogg_file_name)
+			future.add_done_callback(lambda future: self.link(future, ogg_file_name, source_file_name))
+			return
+		source_file_name = self.manifest.get_file(sample_hash)
+		if source_file_name is not None:
+			self.link(None, ogg_file_name, source_file_name)
+			return
+
+		self.slots.acquire()
+		with self.lock:
+			self.in_flight.add(ogg_file_name)
+		try:
+			future = self.executor.submit(encode_sample, ogg_file_name, data)
+		except:
+			with self.lock:
+				self.in_flight.discard(ogg_file_name)
+			self.slots.release()
+			raise
+		self.encoding[sample_hash] = (future, ogg_file_name)
+		self.manifest.files[sample_hash] = ogg_file_name
+		future.add_done_callback(lambda future: self.on_done(future, ogg_file_name))
+
+	def on_done(self, future, ogg_file_name):
+		self.slots.release()
+		with self.lock:
+			self.in_flight.discard(ogg_file_name)
+			if future.exception() is None:
+				self.succeeded += 1
+			else:
+				log.error("\tERROR: %s", future.exception())
+				self.failed.append(ogg_file_name)
+
+	def link(self, future, ogg_file_name, source_file_name):
+		"""Gives ogg_file_name the content of source_file_name, encoded from the same sample (once future is done)"""
+		try:
+			if source_file_name != ogg_file_name:
+				self.link_file(future, ogg_file_name, source_file_name)
+		finally:
+			# Only once the file exists, so that the same name submitted meanwhile is still skipped
+			with self.lock:
+				self.in_flight.discard(ogg_file_name)
+
+	def link_file(self, future, ogg_file_name, source_file_name):
+		try:
+			# The encode of the sample failed, there is nothing to link to
+			if future is not None and future.exception() is not None:
+				raise Exception("the encode of the same sample failed")
+			try:
+				os.link(source_file_name, ogg_file_name)
+			except OSError:
+				# Eg on a file system without hard links
+				shutil.copyfile(source_file_name, ogg_file_name)
+		except Exception as e:
+			with self.lock:
+				log.error("\tERROR: could not link %s: %s", ogg_file_name, e)
+				self.failed.append(ogg_file_name)
+			return
+		with self.lock:
+			self.linked += 1
+		logs.event("link", file = ogg_file_name, source = source_file_name)
+
+	def close(self):
+		self.executor.shutdown(wait = True)
+		log.info("ogg files: %s created, %s linked to an identical sample, %s failed", self.succeeded, self.linked, len(self.failed))
+		for ogg_file_name in self.failed:
+			log.info("\tfailed: %s", ogg_file_name)
+
+
+def extract_assets(env, current_loc, encoder, selected_locales = None):
+	"""Returns the number of audio clips found"""
+	found = 0
 	# iterate over assets
 	for asset in env.assets:
 		# assets without container / internal path will be ignored for now
@@ -106,15 +301,24 @@ def extract_assets(env, current_loc):
 				# print("asset %s" % asset)
 				# print("key %s" % key)
 				# print("obj %s" % obj)
-				export_obj(path, obj, current_loc)
+				found += 1
+				export_obj(path, obj, current_loc, encoder, selected_locales)
 				# return
+	return found
 
 
-def export_obj(path, obj, current_loc):
+def export_obj(path, obj, current_loc, encoder, selected_locales = None):
+	for loc in locales:
+		if ("/" + loc.lower() + "/") in path.lower():
+			current_loc = loc
+	# Checked before reading the clip, which is what takes time
+	if selected_locales and current_loc not in selected_locales:
+		return
+
 	try:
 		data = obj.read()
 	except:
-		print("could not read audio clip %s " % obj)
+		log.error("could not read audio clip %s ", obj)
 		return
 
 	# print("data %s" % data)
@@ -123,14 +327,10 @@ def export_obj(path, obj, current_loc):
 	try:
 		samples = data.samples
 	except Exception as e:
-		print("could not extract samples from %s " % data)
-		print("exception %s " % e)
+		log.error("could not extract samples from %s ", data)
+		log.error("exception %s ", e)
 		return
 	
-	for loc in locales:
-		if ("/" + loc.lower() + "/") in path.lower():
-			current_loc = loc		
-	
 	# print("samples %s" % len(samples))
 	for name, data in samples.items():
 		# print("sample %s, %s" % (name, len(data)))
@@ -138,7 +338,7 @@ def export_obj(path, obj, current_loc):
 		# if "VO_EX1_383_Play_01" not in base_file_name:
 		# 	continue
 
-		print("processing %s" % base_file_name)
+		log.debug("processing %s", base_file_name)
 		wav_file_name = f"{outDir}/sounds_wav/{current_loc}/{base_file_name}.wav"
 		ogg_file_name = f"{outDir}/sounds/{current_loc}/{base_file_name}.ogg"
 		# print("base_file_name %s" % base_file_name)
@@ -146,37 +346,24 @@ def export_obj(path, obj, current_loc):
 		# print("locale %s" % current_loc)
 		# print("path %s" % path)
 
-		# print("warning, this should be uncommented")
-		if os.path.exists(wav_file_name):
-			# print("\t file already exists, continuing")
-			continue
+		encoder.submit(f"{current_loc}/{base_file_name}", wav_file_name, ogg_file_name, data)
 
-		try:
-			with open(wav_file_name, "wb") as f:
-				# print("\textracting wav file %s from %s" % (wav_file_name, path))
-				f.write(data)
-				# print("\t\twav file %s successfully created" % wav_file_name)
-		except Exception as e:
-			# print("\t\tcould not extract wav file %s from %s" % (wav_file_name, path))
-			# print("\t\texception %s " % e)
-			error = 1
-
-		try:
-			# print("\texporting ogg file %s" % ogg_file_name)
-			sound = AudioSegment.from_wav(wav_file_name)		
-			sound.export(ogg_file_name, format="ogg")
-			# print("\t\togg file %s successfully created" % ogg_file_name)
-		except Exception as e:
-			# print("\t\tcould not extract ogg file %s from %s" % (ogg_file_name, path))
-			# print("\t\texception %s " % e)
-			error = 1
 
-		if os.path.exists(ogg_file_name):
-			error = 0
-			# print("\togg file %s successfully created" % ogg_file_name)
-		else:
-			print("\tERROR: ogg file %s not found" % ogg_file_name)
-			# raise Exception("ogg file %s not found" % ogg_file_name)
+def encode_sample(ogg_file_name, data):
+	"""Runs on the OggEncoder threads, raises if the ogg file could not be created. The sample is decoded from memory"""
+	# Written under a temporary name, so that an interrupted export is not taken for an extracted sample. The name is
+	# unique to this encode, so that two encodes never write to the same file
+	# (not tempfile.mkstemp, whose 0600 permissions would end up on the OGG)
+	tmp_file_name = "%s.%s.tmp" % (ogg_file_name, uuid.uuid4().hex)
+	try:
+		with logs.timed("encode", file = ogg_file_name, size = len(data)):
+			sound = AudioSegment.from_wav(io.BytesIO(data))
+			sound.export(tmp_file_name, format="ogg").close()
+			os.replace(tmp_file_name, ogg_file_name)
+	except:
+		if os.path.exists(tmp_file_name):
+			os.remove(tmp_file_name)
+		raise
 
 
 if __name__ == '__main__':
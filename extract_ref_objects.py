@@ -1,10 +1,22 @@
 #!/usr/bin/env python
+import gzip
+import io
 import json
+import multiprocessing
 import os
 import sys
 from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from functools import partial
 
 import UnityPy
+from UnityPy.enums import ClassIDType
+
+import logs
+from asset_scanner import read_object_name
+from dbf_sqlite import DbfSqliteWriter
+from dbf_store import get_locale_overlay_name, make_locale_overlay
+from logs import logger as log
 
 locales = [
 	'deDE',
@@ -194,79 +206,261 @@ nodes_to_parse = [
 	"SPECIAL_EVENT",
 	
 ]
-
-ignored = []
-
-class Logger(object):
-    def __init__(self, logFile):
-        self.terminal = sys.stdout
-        self.log = open(logFile, "a")
-   
-    def write(self, message):
-        self.terminal.write(message)
-        self.log.write(message)  
-
-    def flush(self):
-        # this flush method is needed for python 3 compatibility.
-        # this handles the flush command by doing nothing.
-        # you might want to specify some extra behavior here.
-        pass    
-
-sys.stdout = Logger("extract_ref_objects.log")
+dbf_names = set(nodes_to_parse)
 
 def main():
 	p = ArgumentParser()
 	p.add_argument("src")
+	p.add_argument("--jobs", type=int, default=1, help="Number of worker processes used to scan the files")
+	p.add_argument(
+		"--format", choices=["json", "compact", "ndjson"], default="json",
+		help="json: indented, compact: no whitespace, ndjson: the envelope on the first line, then one record per line"
+	)
+	p.add_argument("--compress", choices=["gzip", "zstd"], help="Compress the output files (zstd requires the zstandard package)")
+	p.add_argument("--sqlite", help="Also write the tables to this SQLite database, with a locale column and indexes on the ids")
+	p.add_argument(
+		"--locale-overlays", action="store_true",
+		help="Write the enUS tables once, and only the strings that differ for the other locales ({name}-{loc}.strings)"
+	)
+	logs.add_logging_arguments(p)
 	args = p.parse_args(sys.argv[1:])
-	extract_ref_objects(args.src)
+	logs.setup_logging("extract_ref_objects", args.verbose, file_mode = "a")
+	extract_ref_objects(args.src, args.jobs, args.format, args.compress, args.sqlite, args.locale_overlays)
 
 
-def extract_ref_objects(src):
+def extract_ref_objects(src, jobs = 1, output_format = "json", compress = None, sqlite_path = None, locale_overlays = False):
+	file_paths = []
 	for root, dirs, files in os.walk(src):
 		for file_name in files:
-			file_path = os.path.join(root, file_name)
-			print(f"processing file {file_name}")
-			# try:
-			env = UnityPy.load(file_path)
-			handle_asset(env)
-			# except Exception as e:
-			# 	print(f"Error processing {file_path}: {e}")
-			# 	continue
+			file_paths.append(os.path.join(root, file_name))
+
+	sqlite_writer = DbfSqliteWriter(sqlite_path) if sqlite_path else None
+	overlay_writer = LocaleOverlayWriter(output_format, compress) if locale_overlays else None
+	keep_records = sqlite_writer is not None or overlay_writer is not None
+	# With the overlays, the tables are serialized here once they are compared to their base table
+	serialize = overlay_writer is None
+	ignored = []
+
+	def write_results(outputs, tables):
+		write_outputs(outputs)
+		write_tables(sqlite_writer, tables)
+		if overlay_writer is not None:
+			for name, loc, records, envelope in tables:
+				write_outputs(overlay_writer.add(name, loc, records, envelope))
+
+	if jobs > 1:
+		with multiprocessing.Pool(jobs, initializer=logs.setup_worker_logging, initargs=("extract_ref_objects", logs.is_verbose())) as pool:
+			# imap keeps the order of the files, so the outputs are written (and overwritten) like in a serial run
+			worker = partial(
+				handle_file_worker, output_format = output_format, compress = compress, keep_records = keep_records, serialize = serialize
+			)
+			for output, outputs, file_ignored, tables in pool.imap(worker, file_paths):
+				logs.replay(output)
+				write_results(outputs, tables)
+				ignored.extend(file_ignored)
+	else:
+		for file_path in file_paths:
+			outputs, file_ignored, tables = handle_file(file_path, output_format, compress, keep_records, serialize)
+			write_results(outputs, tables)
+			ignored.extend(file_ignored)
+
+	if overlay_writer is not None:
+		write_outputs(overlay_writer.finish())
+	if sqlite_writer is not None:
+		sqlite_writer.close()
 			
 	with open('.ignored.log', 'w') as resultFile:
 		resultFile.write(json.dumps(ignored))
-	print("done")
+	log.info("done")
+
+
+class LocaleOverlayWriter:
+	"""
+	--locale-overlays: the base table {name} holds the enUS records (or the records of a DBF found without
+	locale), and the other locales are only written as {name}-{loc}.strings: the string fields that differ from
+	the base, keyed by m_ID and field. A locale that differs in anything else (ids, numbers) gets a full
+	{name}-{loc} copy as before. dbf_store.load_table / DbfStore merge them back.
+
+	Locales found before their base table are kept until it shows up, or written in full at the end.
+	"""
+	def __init__(self, output_format = "json", compress = None):
+		self.output_format = output_format
+		self.compress = compress
+		# name => records of the base table
+		self.bases = {}
+		# name => [(loc, records, envelope)] waiting for their base table
+		self.pending = {}
+
+	def add(self, name, loc, records, envelope):
+		"""The ([file names], data) to write for this table"""
+		tree = get_tree(envelope, records)
+		if loc is None or loc == "enUS":
+			if name in self.bases and self.bases[name] != records:
+				log.warning("base table %s changed, the overlays already written for it are stale", name)
+			self.bases[name] = records
+			outputs = [self.serialize([name], tree)]
+			for pending_loc, pending_records, pending_envelope in self.pending.pop(name, []):
+				outputs.append(self.serialize_locale(name, pending_loc, pending_records, pending_envelope))
+			return outputs
+		if name not in self.bases:
+			self.pending.setdefault(name, []).append((loc, records, envelope))
+			return []
+		return [self.serialize_locale(name, loc, records, envelope)]
+
+	def finish(self):
+		outputs = []
+		for name, pending in self.pending.items():
+			for loc, records, envelope in pending:
+				log.info("no base table for %s-%s, writing it in full", name, loc)
+				outputs.append(self.serialize([name + "-" + loc], get_tree(envelope, records)))
+		self.pending = {}
+		return outputs
+
+	def serialize_locale(self, name, loc, records, envelope):
+		strings = None
+		if records is not None and self.bases[name] is not None:
+			strings = make_locale_overlay(self.bases[name], records)
+		if strings is None:
+			log.info("%s-%s doesn't only differ by its strings, writing it in full", name, loc)
+			return self.serialize([name + "-" + loc], get_tree(envelope, records))
+		log.debug("%s-%s: %s records with localized strings", name, loc, len(strings))
+		# A full copy from a previous run would take precedence over the overlay when loading
+		stale_path = os.path.join("ref/objects", name + "-" + loc + get_extension(self.output_format, self.compress))
+		if os.path.exists(stale_path):
+			os.remove(stale_path)
+		overlay = {"m_Name": name, "locale": loc, "Strings": strings}
+		# The overlay is a single object, so ndjson doesn't apply to it
+		data = serialize_tree(overlay, "compact" if self.output_format == "ndjson" else self.output_format)
+		file_name = get_locale_overlay_name(name, loc) + get_extension("json", self.compress)
+		return [file_name], compress_data(data, self.compress)
+
+	def serialize(self, file_names, tree):
+		ext = get_extension(self.output_format, self.compress)
+		return [file_name + ext for file_name in file_names], compress_data(serialize_tree(tree, self.output_format), self.compress)
+
+
+def get_tree(envelope, records):
+	# Some DBFs (EventMap) don't have records at all
+	return envelope if records is None else dict(envelope, Records = records)
 
 
-def handle_asset(env):
+def handle_file(file_path, output_format = "json", compress = None, keep_records = False, serialize = True):
+	log.debug("processing file %s", os.path.basename(file_path))
+	# try:
+	with logs.timed("file", file = os.path.basename(file_path)) as event:
+		env = UnityPy.load(file_path)
+		outputs, ignored, tables = handle_asset(env, output_format, compress, keep_records, serialize)
+		event["tables"] = max(len(outputs), len(tables))
+	return outputs, ignored, tables
+	# except Exception as e:
+	# 	print(f"Error processing {file_path}: {e}")
+	# 	continue
+
+
+def handle_file_worker(file_path, output_format = "json", compress = None, keep_records = False, serialize = True):
+	# The log is sent back with the results, so that it is written in the same order as a serial run
+	output = io.StringIO()
+	with redirect_stdout(output):
+		outputs, ignored, tables = handle_file(file_path, output_format, compress, keep_records, serialize)
+	return output.getvalue(), outputs, ignored, tables
+
+
+def write_outputs(outputs):
+	for file_names, data in outputs:
+		# The same bytes are written under each name (eg the enUS copy)
+		for file_name in file_names:
+			fp = os.path.join(f"ref/objects", file_name)
+			with open(fp, "wb") as f:
+				f.write(data)
+
+
+def write_tables(sqlite_writer, tables):
+	if sqlite_writer is None:
+		return
+	for name, loc, records, envelope in tables:
+		log.debug("writing %s (%s) to %s", name, loc or "no locale", sqlite_writer.db_path)
+		sqlite_writer.write_table(name, loc, records or [])
+
+
+def serialize_tree(tree, output_format = "json") -> bytes:
+	if output_format == "ndjson":
+		# Records are encoded one at a time, after the Unity envelope
+		envelope = {key: value for key, value in tree.items() if key != "Records"}
+		lines = [json.dumps(envelope, ensure_ascii = False, separators = (",", ":"))]
+		for record in tree.get("Records", []):
+			lines.append(json.dumps(record, ensure_ascii = False, separators = (",", ":")))
+		return ("\n".join(lines) + "\n").encode("utf8")
+	if output_format == "compact":
+		return json.dumps(tree, ensure_ascii = False, separators = (",", ":")).encode("utf8")
+	return json.dumps(tree, ensure_ascii = False, indent = 4).encode("utf8")
+
+
+def compress_data(data: bytes, compress = None) -> bytes:
+	if compress == "gzip":
+		# No timestamp, so that the output only changes with the data
+		return gzip.compress(data, mtime = 0)
+	if compress == "zstd":
+		import zstandard
+		return zstandard.ZstdCompressor(level = 19).compress(data)
+	return data
+
+
+def get_extension(output_format = "json", compress = None) -> str:
+	ext = ".ndjson" if output_format == "ndjson" else ".json"
+	if compress == "gzip":
+		ext += ".gz"
+	elif compress == "zstd":
+		ext += ".zst"
+	return ext
+
+
+def handle_asset(env, output_format = "json", compress = None, keep_records = False, serialize = True):
+	"""
+	Returns the ([file names], data) of the DBF assets found in env, the names of the ignored ones, and with
+	keep_records the (name, locale, records, envelope) of each table. Without serialize, the tables are only
+	returned as records.
+	"""
+	outputs = []
+	ignored = []
+	tables = []
 	for path, pptr in env.container.items():
+		# Only the name is needed to know whether the object is a DBF asset, the full typetree is only read for those.
+		# The DBF assets are MonoBehaviours, the other objects are not even looked at
 		try:
 			data = pptr.deref()
-			tree = data.read_typetree()
+			if data.type != ClassIDType.MonoBehaviour:
+				continue
+			m_Name = read_object_name(data)
 		except:
-			print("could not read %s" % path)
+			log.warning("could not read %s", path)
 			continue
 
 		# continue
 
-		# name = tree["m_Name"]
-		# print(f"processing {name}, {path}")
-		if "m_Name" in tree and tree["m_Name"] is not "":
-			if (tree["m_Name"] == tree["m_Name"].upper()) and tree["m_Name"] not in nodes_to_parse:
+		# print(f"processing {m_Name}, {path}")
+		if m_Name:
+			if (m_Name == m_Name.upper()) and m_Name not in dbf_names:
 				# Only add it if it doesn't start with VO_
-				if not tree["m_Name"].startswith("VO_"):
-					ignored.append(tree["m_Name"])
-					# print("ignoring %s" % tree["m_Name"])
+				if not m_Name.startswith("VO_"):
+					ignored.append(m_Name)
+					# print("ignoring %s" % m_Name)
 
 			# Has some data, but not everything (eg cost is not there, neither is collectible attribute)
-			if tree["m_Name"] in nodes_to_parse:
-				print("parsing %s, %s" % (tree["m_Name"], path))
+			if m_Name in dbf_names:
+				try:
+					tree = data.read_typetree()
+				except:
+					log.warning("could not read %s", path)
+					continue
+				log.info("parsing %s, %s", tree["m_Name"], path)
 				# print("path %s" % path)
 				name = tree["m_Name"]
 				currentLoc = ''
+				tableLoc = None
 				for loc in locales:
 					if loc.lower() in path.lower():
 						currentLoc = "-" + loc
+						tableLoc = loc
 				locName = name + currentLoc
 
 				# local_state["total_handled"] = local_state["total_handled"] + 1
@@ -274,7 +468,7 @@ def handle_asset(env):
 					# Only save the data if it has records
 					tree["Records"]
 				except:
-					print("no records for %s" % tree["m_Name"])
+					log.info("no records for %s", tree["m_Name"])
 					if tree["m_Name"] not in ["EventMap"]:
 						continue	
 
@@ -282,16 +476,22 @@ def handle_asset(env):
 				# Not sure why, but if you don't do this you end up with read errors. Maybe the tree needs to be
 				# fully traversed first so that references are resolved or something?
 				# output = yaml.dump(d)
-				fp = os.path.join(f"ref/objects", f"{locName}.json")
-				with open(fp, "wt", encoding = "utf8") as f:
-					json.dump(tree, f, ensure_ascii = False, indent = 4)
+				ext = get_extension(output_format, compress)
+				file_names = [locName + ext]
 
 				# Store the reference (enUS) without the loc suffix, so that we only explicitly support locs if we want to
 				# print("is ref? %s, %s" % (currentLoc.lower(), currentLoc.lower() == "enus"))
 				if currentLoc.lower() == "enus":
-					fp = os.path.join(f"ref/objects", f"{name}.json")
-					with open(fp, "wt", encoding = "utf8") as f:
-						json.dump(tree, f, ensure_ascii = False, indent = 4)
+					file_names.append(name + ext)
+
+				# Serialized once, even when written under several names
+				if serialize:
+					outputs.append((file_names, compress_data(serialize_tree(tree, output_format), compress)))
+				if keep_records:
+					envelope = {key: value for key, value in tree.items() if key != "Records"}
+					tables.append((name, tableLoc, tree.get("Records"), envelope))
+
+	return outputs, ignored, tables
 
 
 
@@ -1,13 +1,17 @@
 #!/usr/bin/env python
 import tracemalloc
 import gc
+import io
 import json
+import multiprocessing
 import os
 import sys
+import time
 import yaml
 import UnityPy
 from argparse import ArgumentParser
-from typing import List, cast, Dict
+from contextlib import redirect_stdout
+from typing import Callable, List, Optional, cast, Dict
 
 from PIL import Image, ImageOps 
 from UnityPy import Environment
@@ -15,90 +19,197 @@ from UnityPy.enums import ClassIDType
 from UnityPy.helpers import TypeTreeHelper
 from UnityPy.classes import PPtr, GameObject, ComponentPair, Tuple, Component, MonoBehaviour, Material, UnityPropertySheet, AssetBundle
 
-class Logger(object):
-    def __init__(self, logFile):
-        self.terminal = sys.stdout
-        self.log = open(logFile, "w")
-   
-    def write(self, message):
-        self.terminal.write(message)
-        self.log.write(message)  
-
-    def flush(self):
-        # this flush method is needed for python 3 compatibility.
-        # this handles the flush command by doing nothing.
-        # you might want to specify some extra behavior here.
-        pass    
+from asset_index import AssetIndexCache, LazyContainer, DEFAULT_CACHE_PATH
+from asset_scanner import scan_environment
+from checkpoint import CheckpointJournal, open_journal
+import logs
+from logs import logger as log
 
-# sys.stdout = Logger("generate_audio_mapping.log")
+DEFAULT_CHECKPOINT = "generate_audio_mapping.checkpoint.jsonl"
 
 # ./generate_audio_mapping.py /e/Games/Hearthstone/Data/Win
 def main():
 	p = ArgumentParser()
 	p.add_argument("src")
+	p.add_argument("--index-cache", type=str, help="Path to the asset index cache, reused and updated across runs. Implies --lazy")
+	p.add_argument(
+		"--lazy", action="store_true",
+		help="Open the bundles one at a time when needed, instead of loading the whole directory. They are found through the index "
+		"in --index-cache (%s by default): the first run opens every bundle of src once to build it, the next ones only "
+		"the bundles that changed" % DEFAULT_CACHE_PATH
+	)
+	p.add_argument("--jobs", type=int, default=1, help="Number of worker processes, each mapping a shard of the cards at a time")
+	p.add_argument("--shard-size", type=int, default=500, help="Number of cards per shard with --jobs")
+	p.add_argument(
+		"--shard-dir", default="ref/sound_effects_shards",
+		help="Where the shards are written with --jobs. The shards of a run that crashed are reused, they are removed once merged"
+	)
+	p.add_argument("--checkpoint", type=str, help="Journal of the cards already mapped, to resume the run if it crashes")
+	p.add_argument(
+		"--resume", action="store_true",
+		help="Reuse the cards in the journal of a run that didn't complete (--checkpoint, or %s by default). "
+		"With --jobs, the shards are what is reused" % DEFAULT_CHECKPOINT
+	)
+	logs.add_logging_arguments(p)
 	args = p.parse_args(sys.argv[1:])
+	logs.setup_logging("generate_audio_mapping", args.verbose)
 
-	sound_effects = extract_info(args.src)
+	journal = open_journal(args.checkpoint, DEFAULT_CHECKPOINT, args.resume)
+	sound_effects = extract_info(args.src, args.index_cache, args.lazy, args.jobs, args.shard_size, args.shard_dir, journal)
 	with open('./ref/sound_effects.json', 'w') as resultFile:
 		resultFile.write(json.dumps(sound_effects))
-
-
-def extract_info(src):
-	audioClips = {}
-	
-	print("Loading environment")
-	env: Environment = UnityPy.load(src)
- 
-	print("BUilding audio clips mapping")
-	add_audio_clip_mapping(env, audioClips)		
- 
-	print("BUilding cards map")
-	cards_map = build_cards_map(env)	
+	if journal is not None:
+		journal.finish()
+
+
+def extract_info(src, index_cache = None, lazy = False, jobs = 1, shard_size = 500, shard_dir = "ref/sound_effects_shards", journal: Optional[CheckpointJournal] = None):
+	if lazy or index_cache:
+		log.info("Refreshing asset index")
+		cache = AssetIndexCache(index_cache or DEFAULT_CACHE_PATH, src)
+		cache.refresh()
+		cache.save()
+		cards_map = cache.get_cards_map()
+
+		# The prefabs and the sound prefabs are found through the index, and their bundles opened when a card refers to them
+		container = LazyContainer(cache)
+		log.info("Building mapping")
+		# Cards of the same prefab bundle are handled together, so that each bundle is only opened once
+		by_bundle = dict(sorted(cards_map.items(), key=lambda item: container.get_bundle(item[1]) or ""))
+		if jobs > 1:
+			cards = add_card_audio_mapping_parallel(src, cache, by_bundle, jobs, shard_size, shard_dir)
+		else:
+			cards = add_card_audio_mapping(container, by_bundle, container, journal = journal)
+			log.info("bundles opened: %s", container.open_count)
+		# Back to the order of cards_map, so that the output doesn't depend on the loading mode
+		cards = {cardid: cards[cardid] for cardid in cards_map.keys() if cardid in cards}
+	else:
+		log.info("Loading environment")
+		env: Environment = UnityPy.load(src)
+	 
+		log.info("BUilding audio clips mapping and cards map")
+		scan = scan_environment(env)
+		audioClips = scan.container
+		cards_map = scan.cards_map
    
-	print("Building mapping")
-	cards = add_card_audio_mapping(env, cards_map, audioClips)
-	print("cards %s" % len(cards))
-
-	print("Writing filee")
+		log.info("Building mapping")
+		if jobs > 1:
+			# Each worker loads its own environment
+			del env, scan, audioClips
+			gc.collect()
+			cards = add_card_audio_mapping_parallel(src, None, cards_map, jobs, shard_size, shard_dir)
+		else:
+			cards = add_card_audio_mapping(env.container, cards_map, audioClips, journal = journal)
+	log.info("cards %s", len(cards))
+
+	log.info("Writing filee")
 	fp = os.path.join(f"ref/sound_effects.json")
 	with open(fp, "wt", encoding = "utf8") as f:
 		json.dump(cards, f, ensure_ascii = False, indent = 4)
   
-	print("Job's done")
+	log.info("Job's done")
 	return cards
 
 
-def add_audio_clip_mapping(env: Environment, audioClips):
-	for obj in env.objects:
-		if obj.type == ClassIDType.AssetBundle:
-			data = cast(AssetBundle, obj.read())
-			container = data.m_Container
-			for path, asset in container:
-				audioClips[path] = asset.asset
+# State of a --jobs worker process, filled once by init_mapping_worker
+worker_state = {}
+
+def init_mapping_worker(src, cache: Optional[AssetIndexCache], verbose: bool):
+	logs.setup_worker_logging("generate_audio_mapping", verbose)
+	if cache is not None:
+		# The main process has already built the index, only the bundles of the cards of the shard are opened
+		container = LazyContainer(cache)
+		worker_state["container"] = container
+		worker_state["audioClips"] = container
+	else:
+		# UnityPy objects can't be shared across processes
+		env: Environment = UnityPy.load(src)
+		worker_state["container"] = env.container
+		worker_state["audioClips"] = scan_environment(env, cards_map = False).container
+	worker_state["sound_cache"] = SoundCache()
+
+
+def do_mapping_shard(task):
+	"""Maps the cards of a shard, and writes them to shard_path. Returns the log of the shard"""
+	shard_path, shard_cards_map = task
+	output = io.StringIO()
+	with redirect_stdout(output):
+		cards = add_card_audio_mapping(worker_state["container"], shard_cards_map, worker_state["audioClips"], worker_state["sound_cache"])
+	tmp_path = shard_path + ".tmp"
+	with open(tmp_path, "wt", encoding = "utf8") as f:
+		json.dump({"cards_map": shard_cards_map, "cards": cards}, f, ensure_ascii = False)
+	os.replace(tmp_path, shard_path)
+	return output.getvalue()
+
+
+def load_mapping_shard(shard_path, shard_cards_map: Dict[str, str]) -> Optional[dict]:
+	"""The cards of a shard written by a previous run, if it was for the same cards"""
+	if not os.path.exists(shard_path):
+		return None
+	with open(shard_path, "r", encoding = "utf8") as f:
+		shard = json.load(f)
+	return shard["cards"] if shard["cards_map"] == shard_cards_map else None
+
+
+def add_card_audio_mapping_parallel(src, cache: Optional[AssetIndexCache], cards_map: Dict[str, str], jobs: int, shard_size: int, shard_dir: str):
+	"""
+	Same result as add_card_audio_mapping, with the cards split in shards mapped by worker processes. Each shard is
+	written to shard_dir as soon as it is done, so that a run that crashed only maps the missing shards again. The
+	shards are merged in order, so the result (and the JSON written from it) is the same as a serial run.
+	"""
+	os.makedirs(shard_dir, exist_ok = True)
+	items = list(cards_map.items())
+	shards = []
+	for index, start in enumerate(range(0, len(items), shard_size)):
+		shards.append((os.path.join(shard_dir, "shard_%05i.json" % index), dict(items[start:start + shard_size])))
+
+	tasks = [(shard_path, shard_cards_map) for shard_path, shard_cards_map in shards if load_mapping_shard(shard_path, shard_cards_map) is None]
+	log.info("Mapping %i shards of %i cards with %i workers, %i shards reused", len(tasks), shard_size, jobs, len(shards) - len(tasks))
+	if len(tasks) > 0:
+		with multiprocessing.Pool(jobs, initializer=init_mapping_worker, initargs=(src, cache, logs.is_verbose())) as pool:
+			# imap keeps the submission order, so the log reads the same as a serial run
+			for output in pool.imap(do_mapping_shard, tasks):
+				logs.replay(output)
 
- 
-def build_cards_map(env: Environment) -> Dict[str, str]:
-	for obj in env.objects:
-		if obj.type == ClassIDType.MonoBehaviour:
-			dataM: MonoBehaviour = cast(MonoBehaviour, obj.read())
-			if dataM.m_Name == "cards_map":
-				tree = dataM.map
-				keys = tree.keys
-				values = tree.values
-				print("keys: %s" % len(keys))
-				print("values: %s" % len(values))
-				# Build a dictionary of key => prefabid
-				cards_map = {}
-				for cardid, value in zip(keys, values):
-					# if cardid != "SC_004":
-					# 	continue
-					# Only keep the id of the prefab, which means what is after prefab:
-					asset_id = value.split("prefab:")[1]
-					cards_map[cardid] = asset_id
-				return cards_map
-
-
-def add_card_audio_mapping(env: Environment, cards_map: Dict[str, str], audioClips):
+	cards = {}
+	for shard_path, shard_cards_map in shards:
+		cards.update(load_mapping_shard(shard_path, shard_cards_map))
+	for shard_path, shard_cards_map in shards:
+		os.remove(shard_path)
+	if len(os.listdir(shard_dir)) == 0:
+		os.rmdir(shard_dir)
+	return cards
+
+
+class SoundCache:
+	"""
+	The sound prefabs resolved so far, by GUID. Most cards share generic sound spells (default attack and death
+	sounds), whose GameObject, MonoBehaviour and AudioSource are then only read once per run.
+	"""
+	def __init__(self):
+		# (GUID, effect key) => {mainSounds, randomSounds}
+		self.effects = {}
+		# GUID => emote sound file
+		self.emotes = {}
+		self.hits = 0
+		self.misses = 0
+
+	def get(self, cache: dict, key, resolve: Callable):
+		if key in cache:
+			self.hits += 1
+			return cache[key]
+		self.misses += 1
+		cache[key] = resolve()
+		return cache[key]
+
+	def __repr__(self) -> str:
+		lookups = self.hits + self.misses
+		return "%s lookups, %s hits (%.1f%%)" % (lookups, self.hits, 100.0 * self.hits / lookups if lookups > 0 else 0)
+
+
+def add_card_audio_mapping(container, cards_map: Dict[str, str], audioClips, sound_cache: Optional[SoundCache] = None, journal: Optional[CheckpointJournal] = None):
+	"""container is env.container, or a LazyContainer. The cards found in the journal are not read again"""
+	if sound_cache is None:
+		sound_cache = SoundCache()
 	cards = {}
 	current_card_idx = -1
 	for cardid, prefabid in cards_map.items():
@@ -106,8 +217,14 @@ def add_card_audio_mapping(env: Environment, cards_map: Dict[str, str], audioCli
 		# try:
 		# if current_card_idx < 1200:
 		# 	continue
-		prefab_pptr = env.container[prefabid]
-		print("card %s: %s" % (current_card_idx, cardid))
+		entry = None if journal is None else journal.get(cardid, prefabid)
+		if entry is not None:
+			if entry["result"] is not None:
+				cards[cardid] = entry["result"]
+			continue
+		start = time.perf_counter()
+		prefab_pptr = container[prefabid]
+		log.debug("card %s: %s", current_card_idx, cardid)
 		prefab: GameObject = prefab_pptr.read()
 		components: List[ComponentPair] = prefab.m_Component
 
@@ -120,27 +237,27 @@ def add_card_audio_mapping(env: Environment, cards_map: Dict[str, str], audioCli
 				# json.dump(card_def, sys.stdout, ensure_ascii = False, indent = 4)
 				card_def = component_pptr.read()
 				if not hasattr(card_def, "m_PlayEffectDef"):
-					print("\tskipping %s, no m_PlayEffectDef" % cardid)
+					log.debug("\tskipping %s, no m_PlayEffectDef", cardid)
 					continue
 
 				card = {}
 
-				play_sounds = extract_sound_file_names(audioClips, card_def, "m_PlayEffectDef", cardid)
+				play_sounds = extract_sound_file_names(audioClips, card_def, "m_PlayEffectDef", cardid, sound_cache)
 				# print("\tplay_sounds")
 				if len(play_sounds) > 0:
 					card["BASIC_play"] = play_sounds
 
-				attack_sounds = extract_sound_file_names(audioClips, card_def, "m_AttackEffectDef", cardid)
+				attack_sounds = extract_sound_file_names(audioClips, card_def, "m_AttackEffectDef", cardid, sound_cache)
 				# print("\tattack_sounds")
 				if len(attack_sounds) > 0:
 					card["BASIC_attack"] = attack_sounds
 
-				death_sounds = extract_sound_file_names(audioClips, card_def, "m_DeathEffectDef", cardid)
+				death_sounds = extract_sound_file_names(audioClips, card_def, "m_DeathEffectDef", cardid, sound_cache)
 				# print("\tdeath_sounds")
 				if len(death_sounds) > 0:
 					card["BASIC_death"] = death_sounds
 					
-				emote_sounds = extract_emote_sounds(audioClips, card_def, cardid)
+				emote_sounds = extract_emote_sounds(audioClips, card_def, cardid, sound_cache)
 				# print("\temote_sounds")
 				for emoteSound in emote_sounds:
 					card[emoteSound["key"]] = {
@@ -151,26 +268,33 @@ def add_card_audio_mapping(env: Environment, cards_map: Dict[str, str], audioCli
 				
 				# print("\tbuilt card %s" % len(card))
 				cards[cardid] = card
+		if journal is not None:
+			journal.record(cardid, prefabid, cards.get(cardid))
+		logs.event(
+			"audio_mapping", card_id = cardid, duration = round(time.perf_counter() - start, 4),
+			outcome = "ok" if cardid in cards else "skipped"
+		)
 		# except Exception as e:
 		# 	print("ERROR when processing card %s" % cardid)
 		# 	print("\t" + str(e))
 		# 	continue
-	print("done processing cards")
+	log.info("done processing cards")
+	log.info("sound cache: %s", sound_cache)
 	return cards
 
 
-def extract_sound_file_names(audioClips, card_def, nodeName, card_id):
+def extract_sound_file_names(audioClips, card_def, nodeName, card_id, sound_cache: SoundCache):
 	result = {}
 	sound_root_node = card_def.__getattribute__(nodeName)
 	# print("\tsound_root_node %s" % sound_root_node)
 	sound_spell_paths = sound_root_node.__getattribute__("m_SoundSpellPaths")
 	# print("\tsound_spell_paths %s" % sound_spell_paths)
 	for sound_prefab_id_long in sound_spell_paths:
-		extract_sound(audioClips, sound_prefab_id_long, result)
+		extract_sound(audioClips, sound_prefab_id_long, result, sound_cache)
 	return result
   
   
-def extract_sound(audio_clips, sound_prefab_id_long, result):
+def extract_sound(audio_clips, sound_prefab_id_long, result, sound_cache: SoundCache):
 	# print("\t\tconsidering path %s" % sound_prefab_id_long)
 	if not ":" in sound_prefab_id_long:
 		return
@@ -188,12 +312,27 @@ def extract_sound(audio_clips, sound_prefab_id_long, result):
 	result[effectKey] = effect
  
 	sound_prefab_id = sound_prefab_id_long.split(":")[1]
+	resolved = sound_cache.get(
+		sound_cache.effects, (sound_prefab_id, effectKey), lambda: resolve_sound_prefab(audio_clips, sound_prefab_id, effectKey)
+	)
+	if resolved is None:
+		return
+	effect["mainSounds"].extend(resolved["mainSounds"])
+	effect["randomSounds"].extend(resolved["randomSounds"])
+
+
+def resolve_sound_prefab(audio_clips, sound_prefab_id, effectKey) -> Optional[dict]:
+	"""The sounds of a sound prefab, or None if it is missing"""
 	try:
 		pptr: PPtr = cast(PPtr, audio_clips[sound_prefab_id])
 	except:
-		print("Missing sound prefab %s" % sound_prefab_id)
-		return
-  
+		log.warning("Missing sound prefab %s", sound_prefab_id)
+		return None
+
+	effect = {
+		"mainSounds": [],
+		"randomSounds": []
+	}
 	# print("\t\tpptr %s" % pptr)
 	audio_clip: GameObject = cast(GameObject, pptr.read())
 	# print("\t\taudio_clip %s" % audio_clip)
@@ -204,6 +343,7 @@ def extract_sound(audio_clips, sound_prefab_id_long, result):
 		if component_pptr.type.name == "MonoBehaviour":
 			sound_def = component_pptr.read()
 			handle_audio_clip_component(sound_def, effect, effectKey)
+	return effect
   
   
 def handle_audio_clip_component(sound_def, effect, effectKey):  
@@ -252,12 +392,12 @@ def handle_audio_clip_component(sound_def, effect, effectKey):
 		
 
 
-def extract_emote_sounds(audioClips, carddef, card_id):
+def extract_emote_sounds(audioClips, carddef, card_id, sound_cache: SoundCache):
 	sounds = []
 	emoteSounds = carddef.__getattribute__("m_EmoteDefs")
 	for emoteSound in emoteSounds:
 		updatedPath = emoteSound.__getattribute__("m_emoteSoundSpellPath")
-		soundInfo = extract_emote_sound(audioClips, updatedPath, card_id)
+		soundInfo = sound_cache.get(sound_cache.emotes, updatedPath, lambda: extract_emote_sound(audioClips, updatedPath, card_id))
 		if len(soundInfo) > 0:
 			sound = {}
 			sound["key"] = emoteSound.__getattribute__("m_emoteGameStringKey").replace(" ", "")
@@ -301,8 +441,8 @@ def extract_emote_sound(audioClips, updatedPath, card_id):
 						if audio_file_name and len(audio_file_name) > 1:
 							return audio_file_name + ".ogg"
 	except Exception as e:
-		print("ERROR when processing extract_emote_sound %s, %s" % (card_id, updatedPath))
-		print("\t" + str(e))
+		log.error("ERROR when processing extract_emote_sound %s, %s", card_id, updatedPath)
+		log.error("\t%s", e)
 	return ''
 
 def add_to_audio(cardAudios, audioElement):
@@ -1,10 +1,19 @@
 #!/usr/bin/env python
+import csv
+import hashlib
+import io
 import json
+import multiprocessing
 import os
 import sys
+import time
+import types
 import faulthandler; faulthandler.enable()
+import numpy as np
 import UnityPy
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
 from typing import List, cast, Dict, Optional
 
 from PIL import Image, ImageOps, ImageDraw
@@ -13,30 +22,108 @@ from UnityPy.enums import ClassIDType
 from UnityPy.helpers import TypeTreeHelper
 from UnityPy.classes import PPtr, GameObject, ComponentPair, Tuple, Component, MonoBehaviour, Material, UnityPropertySheet, AssetBundle
 
-class Logger(object):
-    def __init__(self, logFile):
-        self.terminal = sys.stdout
-        self.log = open(logFile, "w")
-   
-    def write(self, message):
-        self.terminal.write(message)
-        self.log.write(message)  
+from asset_index import AssetIndexCache, LazyContainer, DEFAULT_CACHE_PATH
+from asset_scanner import scan_environment, read_object_name
+from card_filter import CardFilter
+from checkpoint import CheckpointJournal, open_journal
+from sandbox import SandboxPool
 
-    def flush(self):
-        # this flush method is needed for python 3 compatibility.
-        # this handles the flush command by doing nothing.
-        # you might want to specify some extra behavior here.
-        pass    
+import logs
+from logs import logger as log
 
-sys.stdout = Logger("generate_card_textures.log")
+DEFAULT_CHECKPOINT = "generate_card_textures.checkpoint.jsonl"
 
 class CardTextureInfo:
 	portrait_path: str
 	tile_info: UnityPropertySheet
+	# (x, y, width, height, flip_x, flip_y), precomputed for all the cards by compute_tile_rects
+	tile_rect: Optional[tuple]
  
-	def __init__(self, portrait_path: str, tile_info: UnityPropertySheet):
+	def __init__(self, portrait_path: str, tile_info: UnityPropertySheet, tile_rect: Optional[tuple] = None):
 		self.portrait_path = portrait_path
 		self.tile_info = tile_info
+		self.tile_rect = tile_rect
+
+
+class TextureResolver:
+	"""Finds the texture of a portrait path. The lookup indexes are built once and shared by all cards"""
+	textures: Dict[str, PPtr]
+	textures_lower: Dict[str, str]
+	container: Dict[str, PPtr]
+	texture_names: Optional[List[tuple]]
+
+	def __init__(self, env: Environment, textures: Dict[str, PPtr]):
+		self.env = env
+		self.textures = textures
+		# Keep the first key for each lowercased path, like the scan over the keys used to
+		self.textures_lower = {}
+		for key in textures.keys():
+			self.textures_lower.setdefault(key.lower(), key)
+		# env.container is rebuilt from all the assets on every access
+		self.container = env.container
+		# Only built if a card misses all the other lookups
+		self.texture_names = None
+
+	def resolve(self, card_id: str, portrait_path: str):
+		# Try exact match first, then case-insensitive
+		if portrait_path in self.textures:
+			return self.textures[portrait_path]
+		key = self.textures_lower.get(portrait_path.lower())
+		if key is not None:
+			log.debug("Found texture with case mismatch: '%s' -> '%s'", portrait_path, key)
+			return self.textures[key]
+
+		# Try env.container lookup (GUIDs might be keys there)
+		if portrait_path in self.container:
+			log.debug("Found texture via env.container for %s", card_id)
+			return self.container[portrait_path]
+
+		# Fallback for GUID-based lookups: match the Texture2D names, in the order of env.objects
+		# Some textures might have the GUID in their name or path
+		portrait_path_lower = portrait_path.lower()
+		for name, name_lower, obj in self.get_texture_names():
+			if portrait_path_lower in name_lower or name_lower in portrait_path_lower:
+				log.debug("Found texture by name match for %s (name='%s')", card_id, name)
+				return obj
+		return None
+
+	def get_texture_names(self) -> List[tuple]:
+		if self.texture_names is None:
+			log.info("Building Texture2D names index")
+			self.texture_names = []
+			for obj in self.env.objects:
+				if obj.type == ClassIDType.Texture2D:
+					try:
+						name = read_object_name(obj)
+					except:
+						continue
+					if name:
+						self.texture_names.append((name, name.lower(), obj))
+			log.info("Texture2D names: %s", len(self.texture_names))
+		return self.texture_names
+
+
+class CachedTextureResolver:
+	"""Finds the texture of a portrait path through the asset index, and only opens the bundles holding them"""
+	container: LazyContainer
+
+	def __init__(self, container: LazyContainer):
+		self.container = container
+		# Full environment resolver, for the textures that are not found in the containers
+		self.fallback = None
+
+	def resolve(self, card_id: str, portrait_path: str):
+		if portrait_path not in self.container:
+			return self.get_fallback().resolve(card_id, portrait_path)
+		return self.container[portrait_path]
+
+	def get_fallback(self) -> TextureResolver:
+		if self.fallback is None:
+			log.info("Loading environment")
+			env: Environment = UnityPy.load(self.container.cache.src)
+			self.fallback = TextureResolver(env, scan_environment(env, cards_map = False).container)
+		return self.fallback
+
 
 # ./generate_card_textures.py --outdir out_png --tiles-dir tiles --cards-list cards_list.txt /e/Games/Hearthstone/Data/Win
 # ./generate_card_textures.py --outdir out_png_event --tiles-dir tiles --cards-list cards_list.txt /e/Games/Hearthstone_Event_1/Data/Win
@@ -49,87 +136,333 @@ def main():
 	p.add_argument("--skip-existing", action="store_true")
 	p.add_argument("--orig-dir", type=str, default="orig", help="Name of output for originals")
 	p.add_argument("--tiles-dir", type=str, default="tiles", help="Name of output for tiles")
-	p.add_argument("--cards-list", type=str, help="Path to file with the list of cards to include")
-	# p.add_argument(
-	# 	"--formats", nargs="*", default=["png", "jpg"],
-	# 	help="Which image formats to generate"
-	# )
+	p.add_argument("--cards-list", type=str, help="Path to file with the list of cards to include, one card id or glob pattern (eg BG*) per line")
+	p.add_argument("--jobs", type=int, default=1, help="Number of worker processes used to render the textures")
+	p.add_argument("--index-cache", type=str, help="Path to the asset index cache, reused and updated across runs. Implies --lazy")
+	p.add_argument(
+		"--lazy", action="store_true",
+		help="Open the bundles one at a time when needed, instead of loading the whole directory. They are found through the index "
+		"in --index-cache (%s by default): the first run opens every bundle of src once to build it, the next ones only "
+		"the bundles that changed" % DEFAULT_CACHE_PATH
+	)
+	p.add_argument("--since", type=str, help="Path to the manifest of a previous run: only the cards whose assets changed are generated, and the manifest is updated")
+	p.add_argument("--thumb-sizes", nargs="*", type=int, default=[256, 512], help="Sizes of the thumbnails")
+	p.add_argument(
+		"--formats", nargs="*", default=["jpg"],
+		help="Which image formats to generate for the thumbnails"
+	)
+	p.add_argument("--write-threads", type=int, default=4, help="Number of threads encoding and writing the images")
+	p.add_argument("--tile-rects", type=str, help="Path to a .csv or .json file where the tile properties and crop rectangles of all the cards are dumped")
+	p.add_argument(
+		"--checkpoint", type=str,
+		help="Journal of the cards whose info is built and whose textures are rendered, to resume the run if it crashes"
+	)
+	p.add_argument(
+		"--resume", action="store_true",
+		help="Skip the cards in the journal of a run that didn't complete (--checkpoint, or %s by default)" % DEFAULT_CHECKPOINT
+	)
+	p.add_argument(
+		"--sandbox", action="store_true",
+		help="Render the cards in supervised worker processes (--jobs of them): a card that crashes its worker is recorded as failed, and the run goes on. "
+		"The worker started in its place loads the whole directory again, unless --index-cache / --lazy is used"
+	)
+	p.add_argument("--failures", type=str, default="generate_card_textures.failures.json", help="Where the cards that failed with --sandbox are listed")
+	logs.add_logging_arguments(p)
 	args = p.parse_args(sys.argv[1:])
+	logs.setup_logging("generate_card_textures", args.verbose)
 	generate_card_textures(args.src, args)
 
 
 def generate_card_textures(src, args): 
     # Build an array of cards from the cards-list argument, if present
 	if args.cards_list:
-		with open(args.cards_list, "r") as f:
-			cards_list = [line.strip() for line in f.read().splitlines()]
-			print("cards_list: %s" % len(cards_list))
+		cards_list = CardFilter.from_file(args.cards_list)
+		log.info("cards_list: %r", cards_list)
 	else:
 		cards_list = None
     
-	print("Loading environment")
-	env: Environment = UnityPy.load(src)
-	print("Building cards_map")
-	cards_map = build_cards_map(env, cards_list)
-	print("cards_map: %s" % len(cards_map))
-	# json.dump(cards_map, sys.stdout, ensure_ascii = False, indent = 4)
-	textures_map = build_textures_map(env)
-	print("textures_map: %s" % len(textures_map))
-	cards_info: Dict[str, CardTextureInfo] = build_cards_info(env, cards_map, cards_list)
-	print("cards_info: %s" % len(cards_info))
+	journal = open_journal(args.checkpoint, DEFAULT_CHECKPOINT, args.resume)
+	cache = None
+	if args.lazy or args.index_cache:
+		env = None
+		cache, cards_map, cards_info = load_cards_info_from_index(src, args.index_cache or DEFAULT_CACHE_PATH, cards_list, journal)
+		textures_map = cache.get_container()
+		texture_resolver = CachedTextureResolver(LazyContainer(cache))
+	else:
+		log.info("Loading environment")
+		env: Environment = UnityPy.load(src)
+		log.info("Building cards_map")
+		scan = scan_environment(env, cards_list)
+		cards_map = scan.cards_map
+		log.info("cards_map: %s", len(cards_map))
+		# json.dump(cards_map, sys.stdout, ensure_ascii = False, indent = 4)
+		textures_map = scan.container
+		log.info("textures_map: %s", len(textures_map))
+		texture_resolver = TextureResolver(env, textures_map)
+		cards_info: Dict[str, CardTextureInfo] = build_cards_info(texture_resolver.container, cards_map, cards_list, journal)
+	log.info("cards_info: %s", len(cards_info))
+
+	tile_rects = compute_tile_rects(cards_info)
+	log.info("tile rects: %s", len(tile_rects))
+	if args.tile_rects:
+		dump_tile_rects(args.tile_rects, tile_rects)
 
 	paths = [card.portrait_path for card in cards_info.values()]
-	print("Found %i cards, %i textures including %i unique in use." % (
+	log.info(
+		"Found %i cards, %i textures including %i unique in use.",
 		len(cards_map), len(textures_map), len(set(paths))
-	))
+	)
 
-	thumb_sizes = (256, 512)
-	for card_id, texture_info in cards_info.items():
+	# Fingerprints of the cards that were generated, from the previous runs
+	previous_manifest = load_manifest(args.since) if args.since else {}
+	manifest = dict(previous_manifest)
+
+	# The cards rendered by the run that crashed are not rendered again
+	if journal is not None:
+		remaining = {}
+		for card_id, texture_info in cards_info.items():
+			entry = journal.get(card_id, cards_map[card_id], "render")
+			if entry is None:
+				remaining[card_id] = texture_info
+			else:
+				manifest[card_id] = entry["result"]
+		log.info("cards already rendered: %s", len(cards_info) - len(remaining))
+		cards_info = remaining
+
+	thumb_sizes = args.thumb_sizes
+	if args.sandbox:
+		do_textures_sandboxed(src, cache, cards_map, cards_info, thumb_sizes, previous_manifest, manifest, args, journal)
+	elif args.jobs > 1:
+		do_textures_parallel(src, cache, cards_map, cards_info, thumb_sizes, previous_manifest, manifest, args, journal)
+	else:
+		for card_id, texture_info in cards_info.items():
+			try:
+				# print("processing %r (%r)" % (texture_info, card_id))
+				with logs.timed("render", card_id = card_id) as event:
+					event["outcome"], fingerprint = do_texture(env, card_id, texture_info, texture_resolver, thumb_sizes, args, previous_manifest.get(card_id))
+				if fingerprint is not None:
+					manifest[card_id] = fingerprint
+					record_render(journal, cards_map, card_id, fingerprint)
+			except Exception as e:
+				log.error("ERROR on %r (%r): %s", texture_info, card_id, e)
+				raise
+
+	if args.since:
+		save_manifest(args.since, manifest)
+	if journal is not None:
+		journal.finish()
+	log.info("Job's done")
+
+
+def record_render(journal: Optional[CheckpointJournal], cards_map: Dict[str, str], card_id: str, fingerprint: dict):
+	if journal is not None:
+		journal.record(card_id, cards_map[card_id], fingerprint, "render")
+
+
+def load_manifest(path: str) -> Dict[str, dict]:
+	if not os.path.exists(path):
+		log.info("No manifest at %s, generating all cards", path)
+		return {}
+	with open(path, "r", encoding = "utf8") as f:
+		return json.load(f)
+
+
+def save_manifest(path: str, manifest: Dict[str, dict]):
+	tmp_path = path + ".tmp"
+	with open(tmp_path, "wt", encoding = "utf8") as f:
+		json.dump(manifest, f, ensure_ascii = False, indent = 4, sort_keys = True)
+	os.replace(tmp_path, path)
+	log.info("manifest: %s cards", len(manifest))
+
+
+def get_texture_fingerprint(texture_pptr, texture, texture_info: CardTextureInfo) -> dict:
+	"""What the generated files of a card depend on: the portrait texture, and the properties of the tile Material"""
+	tile_info = dump_texture_info(texture_info)["tile_info"]
+	return {
+		"texture_path_id": texture_pptr.path_id,
+		# image_data is empty for the textures streamed from a .resS file, get_image_data reads them
+		"texture_hash": hashlib.sha1(texture.get_image_data()).hexdigest(),
+		"tile_info_hash": hashlib.sha1(json.dumps(tile_info).encode("utf8")).hexdigest(),
+	}
+
+
+# State of a --jobs worker process, filled once by init_texture_worker
+worker_state = {}
+
+def init_texture_worker(src, cache: Optional[AssetIndexCache], cards_map: Dict[str, str], args):
+	TypeTreeHelper.read_typetree_c = False
+	logs.setup_worker_logging("generate_card_textures", args.verbose)
+	worker_state["cards_map"] = cards_map
+	worker_state["args"] = args
+	if cache is not None:
+		# The main process has already built the index, only the bundles of the textures are opened
+		worker_state["env"] = None
+		worker_state["cache"] = cache
+		worker_state["texture_resolver"] = CachedTextureResolver(LazyContainer(cache))
+	else:
+		# Each worker has its own environment, as UnityPy objects can't be shared across processes
+		env: Environment = UnityPy.load(src)
+		worker_state["env"] = env
+		worker_state["texture_resolver"] = TextureResolver(env, scan_environment(env, cards_map = False).container)
+
+
+def do_texture_worker(task):
+	card_id, thumb_sizes, previous_fingerprint, tile_rect = task
+	env = worker_state["env"]
+	prefab_id = worker_state["cards_map"][card_id]
+	if "cache" in worker_state:
+		texture_info = load_texture_info(worker_state["cache"].get_card(card_id, prefab_id)["info"])
+	else:
+		# The main process already logged how the card info was built, so only keep the rendering output
+		with redirect_stdout(io.StringIO()):
+			cards_info = build_cards_info(worker_state["texture_resolver"].container, {card_id: prefab_id})
+		texture_info = cards_info.get(card_id)
+	if texture_info is not None:
+		texture_info.tile_rect = tile_rect
+	output = io.StringIO()
+	error = None
+	fingerprint = None
+	with redirect_stdout(output):
 		try:
-			# print("processing %r (%r)" % (texture_info, card_id))
-			do_texture(env, card_id, texture_info, textures_map, thumb_sizes, args)
+			with logs.timed("render", card_id = card_id) as event:
+				event["outcome"], fingerprint = do_texture(env, card_id, texture_info, worker_state["texture_resolver"], thumb_sizes, worker_state["args"], previous_fingerprint)
 		except Exception as e:
-			sys.stderr.write("ERROR on %r (%r): %s\n" % (texture_info, card_id, e))
-			raise
-
-	print("Job's done")
-
-
-def build_cards_map(env: Environment, cards_list: Optional[List[str]] = None) -> Dict[str, str]:
-	for obj in env.objects:
-		if obj.type == ClassIDType.MonoBehaviour:
-			dataM: MonoBehaviour = cast(MonoBehaviour, obj.read())
-			if dataM.m_Name == "cards_map":
-				tree = dataM.map
-				keys = tree.keys
-				values = tree.values
-				print("keys: %s" % len(keys))
-				print("values: %s" % len(values))
-				# Build a dictionary of key => prefabid
-				cards_map = {}
-				for cardid, value in zip(keys, values):
-					if cards_list and cardid not in cards_list:
-						# print("skipping build_cards_map %s" % cardid)
-						continue
-					# if "BG" not in cardid:
-					# 	continue
-					# Only keep the id of the prefab, which means what is after prefab:
-					asset_id = value.split("prefab:")[1]
-					cards_map[cardid] = asset_id
-				return cards_map
-	# Return empty dict if no cards_map found
-	return {}
-				
-    
-def build_textures_map(env: Environment) -> Dict[str, PPtr]:
-	textures = {}
-	for obj in env.objects:
-		if obj.type == ClassIDType.AssetBundle:
-			data = cast(AssetBundle, obj.read())
-			container = data.m_Container
-			for path, asset in container:
-				textures[path] = asset.asset
-	return textures
+			error = "ERROR on %r (%r): %s\n" % (texture_info, card_id, e)
+	return card_id, output.getvalue(), error, fingerprint
+
+
+def do_textures_parallel(src, cache: Optional[AssetIndexCache], cards_map: Dict[str, str], cards_info: Dict[str, CardTextureInfo], thumb_sizes, previous_manifest: Dict[str, dict], manifest: Dict[str, dict], args, journal: Optional[CheckpointJournal] = None):
+	worker_cards_map = {card_id: cards_map[card_id] for card_id in cards_info.keys()}
+	tasks = [(card_id, thumb_sizes, previous_manifest.get(card_id), texture_info.tile_rect) for card_id, texture_info in cards_info.items()]
+	log.info("Rendering %i cards with %i workers", len(tasks), args.jobs)
+	with multiprocessing.Pool(args.jobs, initializer=init_texture_worker, initargs=(src, cache, worker_cards_map, args)) as pool:
+		# imap keeps the submission order, so the log reads the same as a serial run
+		for card_id, output, error, fingerprint in pool.imap(do_texture_worker, tasks):
+			logs.replay(output)
+			if error is not None:
+				log.error(error.strip())
+				raise RuntimeError(error.strip())
+			if fingerprint is not None:
+				manifest[card_id] = fingerprint
+				record_render(journal, cards_map, card_id, fingerprint)
+
+
+def do_textures_sandboxed(src, cache: Optional[AssetIndexCache], cards_map: Dict[str, str], cards_info: Dict[str, CardTextureInfo], thumb_sizes, previous_manifest: Dict[str, dict], manifest: Dict[str, dict], args, journal: Optional[CheckpointJournal] = None):
+	"""
+	Same as do_textures_parallel, but the texture reads and decodes run in a SandboxPool: when UnityPy crashes a worker,
+	the card is recorded as failed in args.failures and a new worker takes over. Cards that raise are recorded too,
+	instead of stopping the run. Failed cards are not in the manifest, so that the next --since run tries them again.
+	"""
+	jobs = max(args.jobs, 1)
+	worker_cards_map = {card_id: cards_map[card_id] for card_id in cards_info.keys()}
+	tasks = [(card_id, thumb_sizes, previous_manifest.get(card_id), texture_info.tile_rect) for card_id, texture_info in cards_info.items()]
+	log.info("Rendering %i cards with %i sandboxed workers", len(tasks), jobs)
+	failures = {}
+	with SandboxPool(jobs, do_texture_worker, init_texture_worker, (src, cache, worker_cards_map, args)) as pool:
+		for task, result, error in pool.imap(tasks):
+			card_id = task[0]
+			if result is not None:
+				card_id, output, error, fingerprint = result
+				logs.replay(output)
+			if error is not None:
+				log.error("FAILED %s: %s", card_id, error.strip())
+				if result is None:
+					# The worker died before it could log the event of the card
+					logs.event("render", card_id = card_id, outcome = "crashed", error = error.strip())
+				failures[card_id] = {"portrait_path": cards_info[card_id].portrait_path, "error": error.strip()}
+				continue
+			if fingerprint is not None:
+				manifest[card_id] = fingerprint
+				record_render(journal, cards_map, card_id, fingerprint)
+		log.info("workers crashed: %s", pool.crashes)
+
+	log.info("failed cards: %s", len(failures))
+	tmp_path = args.failures + ".tmp"
+	with open(tmp_path, "wt", encoding = "utf8") as f:
+		json.dump(failures, f, ensure_ascii = False, indent = 4, sort_keys = True)
+	os.replace(tmp_path, args.failures)
+
+
+def load_cards_info_from_index(src, cache_path: Optional[str], cards_list: Optional[CardFilter] = None, journal: Optional[CheckpointJournal] = None):
+	"""
+	Same as loading the environment and building cards_map and cards_info, but the bundles are only opened when needed,
+	and with a cache_path only the cards whose bundles changed since the last run are rebuilt
+	"""
+	cache = AssetIndexCache(cache_path, src)
+	log.info("Refreshing asset index")
+	cache.refresh()
+	cards_map = {}
+	for cardid, prefabid in cache.get_cards_map().items():
+		if cards_list and cardid not in cards_list:
+			continue
+		cards_map[cardid] = prefabid
+	log.info("cards_map: %s", len(cards_map))
+
+	stale = {cardid: prefabid for cardid, prefabid in cards_map.items() if cache.get_card(cardid, prefabid) is None}
+	log.info("cards to rebuild: %s", len(stale))
+	if len(stale) > 0:
+		container = LazyContainer(cache)
+		# Cards of the same prefab bundle are built together, so that each bundle is only opened once
+		stale = dict(sorted(stale.items(), key=lambda item: container.get_bundle(item[1]) or ""))
+		stale_info = build_cards_info(container, stale, cards_list, journal)
+		log.info("bundles opened: %s", container.open_count)
+		for cardid, prefabid in stale.items():
+			texture_info = stale_info.get(cardid)
+			paths = [prefabid] if texture_info is None else [prefabid, texture_info.portrait_path]
+			cache.set_card(cardid, prefabid, paths, dump_texture_info(texture_info))
+	# Even when no card changed, refresh may have indexed or dropped bundles
+	cache.save()
+
+	cards_info = {}
+	for cardid, prefabid in cards_map.items():
+		texture_info = load_texture_info(cache.get_card(cardid, prefabid)["info"])
+		# Cards without art are cached too, so that they are not rebuilt on every run
+		if texture_info is not None:
+			cards_info[cardid] = texture_info
+	return cache, cards_map, cards_info
+
+
+def dump_texture_info(texture_info: Optional[CardTextureInfo]) -> Optional[dict]:
+	if texture_info is None:
+		return None
+	tile_info = None
+	if texture_info.tile_info is not None:
+		tex_envs = []
+		for entry in texture_info.tile_info.m_TexEnvs:
+			if isinstance(entry, tuple):
+				name, tex_env = entry
+				tex_envs.append([name, [tex_env.m_Offset.x, tex_env.m_Offset.y, tex_env.m_Scale.x, tex_env.m_Scale.y]])
+		tile_info = {
+			"m_TexEnvs": tex_envs,
+			"m_Floats": [[key, value] for key, value in texture_info.tile_info.m_Floats],
+		}
+	return {
+		"portrait_path": texture_info.portrait_path,
+		"tile_info": tile_info,
+	}
+
+
+def load_texture_info(data: Optional[dict]) -> Optional[CardTextureInfo]:
+	"""Rebuild a CardTextureInfo from the cache, with a tile_info that only holds what generate_tile_image uses"""
+	if data is None:
+		return None
+	tile_info = None
+	if data["tile_info"] is not None:
+		tex_envs = []
+		for name, (offset_x, offset_y, scale_x, scale_y) in data["tile_info"]["m_TexEnvs"]:
+			tex_env = types.SimpleNamespace(
+				m_Offset = types.SimpleNamespace(x = offset_x, y = offset_y),
+				m_Scale = types.SimpleNamespace(x = scale_x, y = scale_y),
+			)
+			tex_envs.append((name, tex_env))
+		tile_info = types.SimpleNamespace(
+			m_TexEnvs = tex_envs,
+			m_Floats = [(key, value) for key, value in data["tile_info"]["m_Floats"]],
+		)
+	return CardTextureInfo(
+		portrait_path = data["portrait_path"],
+		tile_info = tile_info,
+	)
 
 
 def is_valid_pointer(ptr) -> bool:
@@ -157,11 +490,11 @@ def extract_material_from_unknown_object(unknown_obj, attr_name: str):
 				if isinstance(value, (list, tuple)):
 					for item in value:
 						if hasattr(item, 'path_id') and item.path_id != 0:
-							print("\tExtracted Material from %s.%s" % (attr_name, attr))
+							log.debug("\tExtracted Material from %s.%s", attr_name, attr)
 							return item
 				# If it's a single PPtr, check if it's valid
 				elif hasattr(value, 'path_id') and value.path_id != 0:
-					print("\tExtracted Material from %s.%s" % (attr_name, attr))
+					log.debug("\tExtracted Material from %s.%s", attr_name, attr)
 					return value
 			except:
 				continue
@@ -175,7 +508,8 @@ def get_pointer_path_id(ptr) -> str:
 		return "UnknownObject"
 	return str(ptr.path_id)
 
-def build_cards_info(env: Environment, cards_map: Dict[str, str], cards_list: Optional[List[str]] = None):
+def build_cards_info(container, cards_map: Dict[str, str], cards_list: Optional[CardFilter] = None, journal: Optional[CheckpointJournal] = None):
+	"""container is env.container, or a LazyContainer. The cards found in the journal are not read again"""
 	cards = {}
 	current_card_idx = 0
 	# Iterate over the cards map
@@ -183,8 +517,15 @@ def build_cards_info(env: Environment, cards_map: Dict[str, str], cards_list: Op
 		if cards_list is not None and cardid not in cards_list:
 			# print("skipping build_cards_info %s" % cardid)
 			continue
-		prefab_pptr = env.container[prefabid]
-		print("card %s: %s" % (current_card_idx, cardid))
+		entry = None if journal is None else journal.get(cardid, prefabid)
+		if entry is not None:
+			current_card_idx += 1
+			if entry["result"] is not None:
+				cards[cardid] = load_texture_info(entry["result"])
+			continue
+		start = time.perf_counter()
+		prefab_pptr = container[prefabid]
+		log.debug("card %s: %s", current_card_idx, cardid)
 		current_card_idx += 1
 		prefab = cast(GameObject, prefab_pptr.read())
 		components = cast(List[ComponentPair], prefab.m_Component)
@@ -201,13 +542,13 @@ def build_cards_info(env: Environment, cards_map: Dict[str, str], cards_list: Op
     
 				# Sometimes there's multiple per cardid, we remove the ones without art
 				if not hasattr(card_def, "m_PortraitTexturePath"):
-					print("\tskipping %s, no m_PortraitTexturePath" % cardid)
+					log.debug("\tskipping %s, no m_PortraitTexturePath", cardid)
 					continue
 				portrait_path = card_def.__getattribute__("m_PortraitTexturePath")
 				if ":" in portrait_path:
 					portrait_path = portrait_path.split(":")[1]
 				if len(portrait_path) == 0:
-					print("\tskipping %s, portrait_path is empty" % cardid)
+					log.debug("\tskipping %s, portrait_path is empty", cardid)
 					continue
 				# print("portrait_path: %s" % portrait_path)
 		
@@ -218,7 +559,7 @@ def build_cards_info(env: Environment, cards_map: Dict[str, str], cards_list: Op
 					path_id_val = get_pointer_path_id(tile_ptr)
 					# print("\tm_DeckCardBarPortrait: path_id=%s" % path_id_val)
 				else:
-					print("\tm_DeckCardBarPortrait: attribute not found")
+					log.debug("\tm_DeckCardBarPortrait: attribute not found")
 				
 				# Check for alternative portrait attributes as fallbacks
 				fallback_attrs = ["m_SignatureDeckCardBarPortrait", "m_CustomDeckPortrait", "m_DeckBoxPortrait", "m_DeckPickerPortrait"]
@@ -230,11 +571,11 @@ def build_cards_info(env: Environment, cards_map: Dict[str, str], cards_list: Op
 						# If it's a valid PPtr, use it directly
 						if is_valid_pointer(fallback_ptr):
 							path_id_val = get_pointer_path_id(fallback_ptr)
-							print("\t%s: path_id=%s (available as fallback)" % (attr_name, path_id_val))
+							log.debug("\t%s: path_id=%s (available as fallback)", attr_name, path_id_val)
 							if not is_valid_pointer(tile_ptr):
 								tile_ptr = fallback_ptr
 								fallback_found = True
-								print("\tUsing %s as fallback" % attr_name)
+								log.debug("\tUsing %s as fallback", attr_name)
 								break
 						# If it's an UnknownObject, try to extract a Material from it
 						elif fallback_ptr is not None and not hasattr(fallback_ptr, 'path_id'):
@@ -243,7 +584,7 @@ def build_cards_info(env: Environment, cards_map: Dict[str, str], cards_list: Op
 								if not is_valid_pointer(tile_ptr):
 									tile_ptr = extracted_material
 									fallback_found = True
-									print("\tUsing Material extracted from %s as fallback" % attr_name)
+									log.debug("\tUsing Material extracted from %s as fallback", attr_name)
 									break
 			
 				tile: Material = None if not is_valid_pointer(tile_ptr) else tile_ptr.read()
@@ -251,108 +592,143 @@ def build_cards_info(env: Environment, cards_map: Dict[str, str], cards_list: Op
 				tile_info = None if tile == None else tile.m_SavedProperties
 				if tile_info is None:
 					path_id_str = get_pointer_path_id(tile_ptr)
-					print("\tWARNING: tile_info is None for %s (tile_ptr.path_id=%s)" % (
+					log.warning(
+						"\tWARNING: tile_info is None for %s (tile_ptr.path_id=%s)",
 						cardid, path_id_str
-					))
+					)
 				else:
-					print("\ttile_info: found")
+					log.debug("\ttile_info: found")
 				texture_info: CardTextureInfo = CardTextureInfo(
 					portrait_path = portrait_path.lower(),
 					tile_info = tile_info,
 				)
 				cards[cardid] = texture_info
+		if journal is not None:
+			journal.record(cardid, prefabid, dump_texture_info(cards.get(cardid)))
+			# Only in the main process, the --jobs workers build the info of their cards again without a journal
+			logs.event(
+				"card_info", card_id = cardid, duration = round(time.perf_counter() - start, 4),
+				outcome = "ok" if cardid in cards else "skipped"
+			)
 
 	return cards
 
 
-def do_texture(env: Environment, card_id: str, texture_info: CardTextureInfo, textures: Dict[str, PPtr], thumb_sizes, args):
+def do_texture(env: Environment, card_id: str, texture_info: CardTextureInfo, texture_resolver: TextureResolver, thumb_sizes, args, previous_fingerprint: Optional[dict] = None) -> tuple:
+	"""
+	Generate the files of a card. Returns the outcome (ok, unchanged, skipped when all its files exist, not_found,
+	error), and its fingerprint when --since or the journal is used and the card was handled
+	"""
 	try:
-		# Check if the texture exists in the map (try exact match first, then case-insensitive)
 		portrait_path = texture_info.portrait_path
-		texture_pptr = None
-		
-		if portrait_path in textures:
-			texture_pptr = textures[portrait_path]
-		else:
-			# Try case-insensitive lookup
-			portrait_path_lower = portrait_path.lower()
-			for key in textures.keys():
-				if key.lower() == portrait_path_lower:
-					texture_pptr = textures[key]
-					print("Found texture with case mismatch: '%s' -> '%s'" % (portrait_path, key))
-					break
-		
-		# If still not found, try looking up by GUID in env.container or searching Texture2D objects
-		if texture_pptr is None:
-			# Try env.container lookup (GUIDs might be keys there)
-			if portrait_path in env.container:
-				texture_pptr = env.container[portrait_path]
-				print("Found texture via env.container for %s" % card_id)
-			else:
-				# Search through Texture2D objects and try to match by name or other properties
-				# This is a fallback for GUID-based lookups
-				for obj in env.objects:
-					if obj.type == ClassIDType.Texture2D:
-						try:
-							texture_data = obj.read()
-							# Check if the texture name or path matches
-							if hasattr(texture_data, 'm_Name') and texture_data.m_Name:
-								# Some textures might have the GUID in their name or path
-								texture_name_lower = texture_data.m_Name.lower()
-								if portrait_path.lower() in texture_name_lower or texture_name_lower in portrait_path.lower():
-									texture_pptr = obj
-									print("Found texture by name match for %s (name='%s')" % (card_id, texture_data.m_Name))
-									break
-						except:
-							continue
-		
+		texture_pptr = texture_resolver.resolve(card_id, portrait_path)
+
 		if texture_pptr is None:
-			print("ERROR: Texture not found for %s (portrait_path='%s')" % (card_id, portrait_path))
-			return
+			log.error("ERROR: Texture not found for %s (portrait_path='%s')", card_id, portrait_path)
+			return "not_found", None
 			
-		print("texture_pptr: %s" % texture_pptr)
+		log.debug("texture_pptr: %s", texture_pptr)
 		texture = texture_pptr.read()
-		print("texture: %s" % texture)
-		flipped = None
-		filename, exists = get_filename(args.outdir, args.orig_dir, card_id, ext=".png")
-
-		if not (args.skip_existing and exists):
-			print("-> %r" % (filename))
-			flipped = texture.image.copy().convert("RGB")
-			flipped.save(filename)
-
-		ext = ".png"
-		filename, exists = get_filename(args.outdir, args.tiles_dir, card_id, ext=ext)
-		if not (args.skip_existing and exists):
-			# print("will build texture for %r" % (filename))
-			if not texture.image:
-				print("texture has no image %s" % card_id)
-			use_secondary_value = "coin" in card_id.lower()
-			tile_texture = generate_tile_image(card_id, env, texture.image, texture_info.tile_info, use_secondary_value)
-			if not tile_texture:
-				print("could not generate tile texture %s" % card_id)
-				# Some hero skins have no tiles, but still have the thumb
-			else:
-				print("-> %r" % (filename))
-				tile_texture.save(filename)
+		log.debug("texture: %s", texture)
 
-		ext = ".jpg"
-		for sz in thumb_sizes:
+		orig_filename, orig_exists = get_filename(args.outdir, args.orig_dir, card_id, ext=".png")
+		fingerprint = None
+		# The journal records the fingerprint of each card rendered, which is also what tells that it was rendered
+		if args.since or args.checkpoint or args.resume:
+			fingerprint = get_texture_fingerprint(texture_pptr, texture, texture_info)
+			if fingerprint == previous_fingerprint and orig_exists:
+				log.debug("unchanged %s", card_id)
+				return "unchanged", fingerprint
+
+		write_orig = not (args.skip_existing and orig_exists)
+		tile_filename, tile_exists = get_filename(args.outdir, args.tiles_dir, card_id, ext=".png")
+		write_tile = not (args.skip_existing and tile_exists)
+		# size => files to write, largest first
+		thumb_filenames = {}
+		for sz in sorted(thumb_sizes, reverse=True):
 			thumb_dir = "%ix" % (sz)
-			filename, exists = get_filename(args.outdir, thumb_dir, card_id, ext=ext)
-			if not (args.skip_existing and exists):
+			thumb_filenames[sz] = []
+			for fmt in args.formats:
+				filename, exists = get_filename(args.outdir, thumb_dir, card_id, ext="." + fmt)
+				if not (args.skip_existing and exists):
+					thumb_filenames[sz].append(filename)
+		write_thumbs = any(len(filenames) > 0 for filenames in thumb_filenames.values())
+		if not (write_orig or write_tile or write_thumbs):
+			return "skipped", fingerprint
+
+		# Decode the texture once for all the outputs
+		image = texture.image
+		flipped = None
+		with ImageWriter(get_image_executor(args.write_threads)) as writer:
+			if write_orig:
+				flipped = image.convert("RGB")
+				writer.save(flipped, orig_filename)
+
+			# The tile is computed while the original is encoded
+			if write_tile:
+				# print("will build texture for %r" % (tile_filename))
+				if not image:
+					log.warning("texture has no image %s", card_id)
+				use_secondary_value = "coin" in card_id.lower()
+				tile_texture = generate_tile_image(card_id, env, image, texture_info.tile_info, use_secondary_value, texture_info.tile_rect)
+				if not tile_texture:
+					log.warning("could not generate tile texture %s", card_id)
+					# Some hero skins have no tiles, but still have the thumb
+				else:
+					writer.save(tile_texture, tile_filename)
+
+			if write_thumbs:
 				if not flipped:
-					flipped = texture.image.copy().convert("RGB")
-				thumb_texture = flipped.resize((sz, sz))
-				print("-> %r" % (filename))
-				thumb_texture.save(filename)
+					flipped = image.convert("RGB")
+				# Each thumbnail is resized from the previous (larger) one rather than from the full image
+				thumb_texture = flipped
+				for sz, filenames in thumb_filenames.items():
+					thumb_texture = thumb_texture.resize((sz, sz))
+					for filename in filenames:
+						writer.save(thumb_texture, filename)
+		return "ok", fingerprint
 	except Exception as e:
-		print("ERROR on %r (%r): %s" % (texture_info, card_id, e))
+		log.error("ERROR on %r (%r): %s", texture_info, card_id, e)
+		return "error", None
         
 
 
-def generate_tile_image(card_id: str, env: Environment, img, tile_info, use_secondary_value):
-	print("card_id: %s, tile: %s" % (card_id, tile_info))    
+# Encoders and file writes, shared by all the cards of the process
+image_executor = None
+
+def get_image_executor(max_workers: int) -> ThreadPoolExecutor:
+	global image_executor
+	if image_executor is None:
+		image_executor = ThreadPoolExecutor(max_workers)
+	return image_executor
+
+
+class ImageWriter:
+	"""Saves the images of a card on a thread pool (Pillow's encoders release the GIL), and waits for all of them on exit"""
+	executor: ThreadPoolExecutor
+
+	def __init__(self, executor: ThreadPoolExecutor):
+		self.executor = executor
+		self.pending = []
+
+	def save(self, image, filename: str):
+		log.debug("-> %r", filename)
+		self.pending.append(self.executor.submit(image.save, filename))
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		errors = [future.exception() for future in self.pending]
+		errors = [error for error in errors if error is not None]
+		# Don't hide an exception raised while building the images
+		if exc_type is None and len(errors) > 0:
+			raise errors[0]
+		return False
+
+
+def generate_tile_image(card_id: str, env: Environment, img, tile_info, use_secondary_value, tile_rect: Optional[tuple] = None):
+	log.debug("card_id: %s, tile: %s", card_id, tile_info)
 	if (img.width, img.height) != (512, 512):
 		img = img.resize((512, 512), Image.ANTIALIAS)
   
@@ -371,18 +747,23 @@ def generate_tile_image(card_id: str, env: Environment, img, tile_info, use_seco
 	extra_offset_x = 0.0
 	extra_offset_y = 0.0
 	extra_scale = 1.0
+	flip_x = False
+	flip_y = False
  
-	if tile_info is not None:		
+	if tile_rect is not None:
+		x, y, width, height, flip_x, flip_y = tile_rect
+		log.debug("rect precomputed: x=%d, y=%d, width=%d, height=%d", x, y, width, height)
+	elif tile_info is not None:		
 		main_tex = None
 		for entry in tile_info.m_TexEnvs:
 			if isinstance(entry, tuple) and entry[0] == "_MainTex":
 				main_tex = entry[1]
-				print("found main_tex: %s" % main_tex)
+				log.debug("found main_tex: %s", main_tex)
 				break
 		if main_tex is None:
-			print("No _MainTex found in m_TexEnvs")
+			log.debug("No _MainTex found in m_TexEnvs")
 			return None
-		print("main_tex: %s" % main_tex)
+		log.debug("main_tex: %s", main_tex)
 		offset_x = main_tex.m_Offset.x
 		offset_y = main_tex.m_Offset.y
 		scale_x = main_tex.m_Scale.x
@@ -397,26 +778,28 @@ def generate_tile_image(card_id: str, env: Environment, img, tile_info, use_seco
 			extra_offset_x, extra_offset_y, extra_scale,
 			img.width
 		)
+		flip_x = scale_x * extra_scale < 0
+		flip_y = scale_y * extra_scale < 0
 	# Hardcode the value (taken from the Counterfeit coin)
 	elif use_secondary_value:
 		x = 467
 		y = 223
 		width = 440
 		height = 101
-		print("rect secondary: x=%d, y=%d, width=%d, height=%d" % (x, y, width, height))
+		log.debug("rect secondary: x=%d, y=%d, width=%d, height=%d", x, y, width, height)
   	# For BG
 	elif "bg" in card_id.lower():
 		x = 0
 		y = 300
 		width = 512
 		height = 117
-		print("rect: x=%d, y=%d, width=%d, height=%d" % (x, y, width, height))
+		log.debug("rect: x=%d, y=%d, width=%d, height=%d", x, y, width, height)
 	else:
 		x = 467
 		y = 223
 		width = 440
 		height = 101
-		print("rect default: x=%d, y=%d, width=%d, height=%d" % (x, y, width, height))
+		log.debug("rect default: x=%d, y=%d, width=%d, height=%d", x, y, width, height)
 
 	# Clamp to image bounds
 	x = max(0, min(x, img.width * 2 - 1))
@@ -430,9 +813,9 @@ def generate_tile_image(card_id: str, env: Environment, img, tile_info, use_seco
 	bar = tiled.crop((x, y, x + width, y + height))
 
 	# Flip if negative scale
-	if scale_x * extra_scale < 0:
+	if flip_x:
 		bar = ImageOps.mirror(bar)
-	if scale_y * extra_scale < 0:
+	if flip_y:
 		bar = ImageOps.flip(bar)
 
 	# Make white background transparent
@@ -449,53 +832,61 @@ def generate_tile_image(card_id: str, env: Environment, img, tile_info, use_seco
  
 def make_white_bg_transparent(img, threshold=240):
     img = img.convert("RGBA")
-    w, h = img.size
-    mask = Image.new("L", (w, h), 0)
-    pixels = img.load()
-    mask_pixels = mask.load()
-
-    # Helper to check if a pixel is "white enough"
-    def is_white(px):
-        return px[0] >= threshold and px[1] >= threshold and px[2] >= threshold
-
-    # Flood fill from all white border pixels
-    from collections import deque
-    queue = deque()
-
-    # Add all white border pixels to the queue
-    for x in range(w):
-        if is_white(pixels[x, 0]):
-            queue.append((x, 0))
-        if is_white(pixels[x, h-1]):
-            queue.append((x, h-1))
-    for y in range(h):
-        if is_white(pixels[0, y]):
-            queue.append((0, y))
-        if is_white(pixels[w-1, y]):
-            queue.append((w-1, y))
-
-    # Directions: up, down, left, right
-    directions = [(-1,0), (1,0), (0,-1), (0,1)]
-
-    # Flood fill
-    while queue:
-        x, y = queue.popleft()
-        if 0 <= x < w and 0 <= y < h and mask_pixels[x, y] == 0 and is_white(pixels[x, y]):
-            mask_pixels[x, y] = 255
-            for dx, dy in directions:
-                queue.append((x+dx, y+dy))
-
-    # Apply mask: set alpha to 0 where mask is 255
-    new_pixels = []
-    for y in range(h):
-        for x in range(w):
-            r, g, b, a = pixels[x, y]
-            if mask_pixels[x, y] == 255:
-                new_pixels.append((r, g, b, 0))
-            else:
-                new_pixels.append((r, g, b, a))
-    img.putdata(new_pixels)
-    return img
+    pixels = np.array(img)
+
+    # "White enough" pixels, computed for the whole image at once
+    white = (pixels[:, :, 0] >= threshold) & (pixels[:, :, 1] >= threshold) & (pixels[:, :, 2] >= threshold)
+
+    # Same result as a flood fill from all white border pixels: keep the white regions
+    # (4-connected) that touch the border
+    labels = label_white_regions(white)
+    is_background = np.zeros(labels.max() + 1, dtype=bool)
+    is_background[labels[0, :]] = True
+    is_background[labels[-1, :]] = True
+    is_background[labels[:, 0]] = True
+    is_background[labels[:, -1]] = True
+    is_background[0] = False
+    background = is_background[labels]
+
+    # Apply mask: set alpha to 0 on the background
+    pixels[:, :, 3][background] = 0
+    return Image.fromarray(pixels, "RGBA")
+
+
+def label_white_regions(white):
+    """Label the 4-connected white regions of a boolean mask, 0 being the non-white pixels"""
+    h, w = white.shape
+    flat = white.ravel()
+    # Split every row into runs of white pixels: a run starts on a white pixel that begins
+    # a row or follows a non-white pixel
+    starts = flat.copy()
+    starts[1:] &= ~flat[:-1]
+    starts[::w] = flat[::w]
+    run_ids = np.cumsum(starts).reshape(h, w)
+    run_ids[~white] = 0
+
+    # Runs that touch vertically belong to the same region. Only keep the first column of
+    # each overlap, as the next ones link the same two runs
+    touching = white[:-1] & white[1:]
+    touching[:, 1:] &= ~touching[:, :-1]
+    top, bottom = run_ids[:-1][touching], run_ids[1:][touching]
+
+    # Merge the linked runs: hook each root on the smallest label of its links, then
+    # shortcut the chains, until all the linked runs share the same label
+    labels = np.arange(np.count_nonzero(starts) + 1)
+    while True:
+        labels_top, labels_bottom = labels[top], labels[bottom]
+        if (labels_top == labels_bottom).all():
+            break
+        smallest = np.minimum(labels_top, labels_bottom)
+        np.minimum.at(labels, labels_top, smallest)
+        np.minimum.at(labels, labels_bottom, smallest)
+        while True:
+            shortcut = labels[labels]
+            if (shortcut == labels).all():
+                break
+            labels = shortcut
+    return labels[run_ids]
 
 
 def get_float(m_Floats, key, default=0.0):
@@ -563,6 +954,99 @@ def get_rect(ux, uy, usx, usy, sx, sy, ss, tex_dim=512):
     return (x, y, width, height)
 
 
+TILE_PROPERTIES = ["offset_x", "offset_y", "scale_x", "scale_y", "extra_offset_x", "extra_offset_y", "extra_scale"]
+TILE_RECT = ["x", "y", "width", "height", "flip_x", "flip_y"]
+
+def compute_tile_rects(cards_info: Dict[str, CardTextureInfo], tex_dim=512) -> Dict[str, dict]:
+	"""
+	Extract the tile properties of all the cards in columns, compute all the crop rectangles in one pass,
+	and store them in each CardTextureInfo.tile_rect. Cards without tile_info (or without _MainTex) are left
+	to generate_tile_image. Returns card_id => properties and rect, for auditing.
+	"""
+	card_ids = []
+	rows = []
+	for card_id, texture_info in cards_info.items():
+		tile_info = texture_info.tile_info
+		if tile_info is None:
+			continue
+		main_tex = None
+		for entry in tile_info.m_TexEnvs:
+			if isinstance(entry, tuple) and entry[0] == "_MainTex":
+				main_tex = entry[1]
+				break
+		if main_tex is None:
+			continue
+		# First value wins, like get_float
+		floats = {}
+		for key, value in tile_info.m_Floats:
+			floats.setdefault(key, value)
+		card_ids.append(card_id)
+		rows.append((
+			main_tex.m_Offset.x, main_tex.m_Offset.y, main_tex.m_Scale.x, main_tex.m_Scale.y,
+			floats.get("_OffsetX", 0.0), floats.get("_OffsetY", 0.0), floats.get("_Scale", 1.0),
+		))
+	if len(rows) == 0:
+		return {}
+
+	props = np.array(rows, dtype=np.float64)
+	x, y, width, height = get_rects(*props.T, tex_dim=tex_dim)
+	flip_x = props[:, 2] * props[:, 6] < 0
+	flip_y = props[:, 3] * props[:, 6] < 0
+
+	table = {}
+	for i, card_id in enumerate(card_ids):
+		tile_rect = (int(x[i]), int(y[i]), int(width[i]), int(height[i]), bool(flip_x[i]), bool(flip_y[i]))
+		cards_info[card_id].tile_rect = tile_rect
+		table[card_id] = dict(zip(TILE_PROPERTIES + TILE_RECT, [float(value) for value in props[i]] + list(tile_rect)))
+	return table
+
+
+def dump_tile_rects(path: str, table: Dict[str, dict]):
+	if path.endswith(".json"):
+		with open(path, "wt", encoding = "utf8") as f:
+			json.dump(table, f, indent = 4)
+	else:
+		with open(path, "wt", encoding = "utf8", newline = "") as f:
+			writer = csv.writer(f)
+			writer.writerow(["card_id"] + TILE_PROPERTIES + TILE_RECT)
+			for card_id, row in table.items():
+				writer.writerow([card_id] + [row[column] for column in TILE_PROPERTIES + TILE_RECT])
+	log.info("-> %r", path)
+
+
+def get_rects(ux, uy, usx, usy, sx, sy, ss, tex_dim=512):
+	"""Same as get_rect, on arrays of properties"""
+	tl_u = ((TEX_COORDS[0][0] + sx) * ss) * usx + ux
+	tl_v = ((TEX_COORDS[0][1] + sy) * ss) * usy + uy
+	br_u = ((TEX_COORDS[1][0] + sx) * ss) * usx + ux
+	br_v = ((TEX_COORDS[1][1] + sy) * ss) * usy + uy
+
+	# Handle horizontal crossover (if needed)
+	horiz_delta = np.maximum(tl_u - br_u, 0)
+	tl_u = tl_u - horiz_delta
+	br_u = br_u + horiz_delta
+
+	# Convert UVs to pixel coordinates (np.round rounds half to even, like round)
+	x = np.round(tl_u * tex_dim).astype(np.int64)
+	y = np.round(tl_v * tex_dim).astype(np.int64)
+	width = np.round(np.abs((br_u - tl_u) * tex_dim)).astype(np.int64)
+	height = np.round(np.abs((br_v - tl_v) * tex_dim)).astype(np.int64)
+
+	# Adjust x and y for wrap-around/tiling
+	x = (x + width) % tex_dim - width
+	y = (y + height) % tex_dim - height
+
+	# Ensure minimum visible area: add tex_dim as many times as the loops of get_rect would
+	min_visible = tex_dim // 4
+	x = x + np.maximum(0, -((x + width - min_visible) // tex_dim)) * tex_dim
+	y = y + np.maximum(0, -((y + height) // tex_dim)) * tex_dim
+
+	# Final wrap for negative x
+	x = np.where(x < 0, x + tex_dim, x)
+
+	return (x, y, width, height)
+
+
 def get_dir(basedir, dirname):
 	ret = os.path.join(basedir, dirname)
 	if not os.path.exists(ret):
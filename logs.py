@@ -0,0 +1,148 @@
+"""
+Logging shared by the scripts. Messages go to the console and to {name}.log, and events (card id, stage, duration,
+outcome) to {name}.events.jsonl, one JSON object per line.
+
+The files are written by a background thread, with buffered writes, so that logging doesn't slow the card loops
+down. The details of each card / file are logged at debug level, and only shown with -v.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from contextlib import contextmanager
+
+logger = logging.getLogger("hsjson")
+events = logging.getLogger("hsjson.events")
+
+listener = None
+
+
+class ConsoleHandler(logging.StreamHandler):
+	"""Writes to the current sys.stdout, so that the output of a worker can be captured with redirect_stdout"""
+	def __init__(self):
+		super().__init__(sys.stdout)
+
+	def emit(self, record):
+		self.stream = sys.stdout
+		super().emit(record)
+
+
+class BufferedFileHandler(logging.FileHandler):
+	"""Leaves the flushing to the file buffer (and to close), instead of a write call per line"""
+	def _open(self):
+		return open(self.baseFilename, self.mode, buffering = 1024 * 1024, encoding = self.encoding)
+
+	def flush(self):
+		pass
+
+
+class JsonFormatter(logging.Formatter):
+	def format(self, record):
+		event = {"time": round(record.created, 3), "stage": record.getMessage()}
+		event.update(getattr(record, "fields", {}))
+		return json.dumps(event, ensure_ascii = False)
+
+
+def is_event(record) -> bool:
+	return record.name == events.name
+
+
+def is_message(record) -> bool:
+	return not is_event(record)
+
+
+def add_logging_arguments(parser):
+	parser.add_argument("-v", "--verbose", action="store_true", help="Log the details of each card / file")
+
+
+def setup_logging(name: str, verbose: bool = False, timestamps: bool = False, file_mode: str = "w"):
+	global listener
+	if listener is not None:
+		listener.stop()
+	logger.setLevel(logging.DEBUG if verbose else logging.INFO)
+	logger.propagate = False
+	logger.handlers = []
+
+	console = ConsoleHandler()
+	console.setFormatter(logging.Formatter("[%(asctime)s] %(message)s" if timestamps else "%(message)s"))
+	console.addFilter(is_message)
+	logger.addHandler(console)
+
+	log_file = BufferedFileHandler(name + ".log", mode = file_mode, encoding = "utf8")
+	log_file.setFormatter(logging.Formatter("[%(asctime)s] %(levelname)s %(message)s"))
+	log_file.addFilter(is_message)
+	# Only events are written with flushes, so that the workers can append to the same file (see setup_worker_logging).
+	# Truncated first, then opened in append mode, so that a write of the main process doesn't overwrite theirs
+	open(name + ".events.jsonl", "w").close()
+	event_file = logging.FileHandler(name + ".events.jsonl", mode = "a", encoding = "utf8")
+	event_file.setFormatter(JsonFormatter())
+	event_file.addFilter(is_event)
+
+	records = queue.SimpleQueue()
+	logger.addHandler(logging.handlers.QueueHandler(records))
+	listener = logging.handlers.QueueListener(records, log_file, event_file)
+	listener.start()
+
+
+def setup_worker_logging(name: str, verbose: bool = False):
+	"""
+	For the worker processes: messages only go to the console (that the caller captures and sends back to the main
+	process, see replay), and events are appended to the file of the main process
+	"""
+	global listener
+	# A forked worker has a copy of the listener, without its thread
+	listener = None
+	logger.setLevel(logging.DEBUG if verbose else logging.INFO)
+	logger.propagate = False
+	logger.handlers = []
+
+	console = ConsoleHandler()
+	console.setFormatter(logging.Formatter("%(message)s"))
+	console.addFilter(is_message)
+	logger.addHandler(console)
+
+	event_file = logging.FileHandler(name + ".events.jsonl", mode = "a", encoding = "utf8")
+	event_file.setFormatter(JsonFormatter())
+	event_file.addFilter(is_event)
+	logger.addHandler(event_file)
+
+
+def stop_logging():
+	global listener
+	if listener is not None:
+		listener.stop()
+		listener = None
+
+# Registered after logging's own handler, so it runs before it: the queue is emptied before the files are closed
+atexit.register(stop_logging)
+
+
+def is_verbose() -> bool:
+	"""To pass the verbosity on to the worker processes"""
+	return logger.isEnabledFor(logging.DEBUG)
+
+
+def replay(output: str):
+	"""Logs the output captured in a worker process"""
+	if len(output) > 0:
+		logger.info(output.rstrip("\n"))
+
+
+def event(stage: str, **fields):
+	events.info(stage, extra = {"fields": fields})
+
+
+@contextmanager
+def timed(stage: str, **fields):
+	"""Logs an event for the block, with its duration and whether it raised"""
+	start = time.perf_counter()
+	try:
+		yield fields
+	except BaseException as e:
+		event(stage, **{"duration": round(time.perf_counter() - start, 4), "outcome": "error", "error": str(e), **fields})
+		raise
+	# The block can set its own outcome (eg skipped) in the fields
+	event(stage, **{"duration": round(time.perf_counter() - start, 4), "outcome": "ok", **fields})
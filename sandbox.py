@@ -0,0 +1,136 @@
+"""Worker processes supervised so that a crash in native code (UnityPy's decoders) only fails the task that caused it"""
+import multiprocessing
+from multiprocessing.connection import wait
+from typing import Callable, Iterable, Optional
+
+
+def worker_loop(conn, func: Callable, initializer: Optional[Callable], initargs: tuple):
+	if initializer is not None:
+		initializer(*initargs)
+	while True:
+		try:
+			task = conn.recv()
+		except EOFError:
+			break
+		if task is None:
+			break
+		try:
+			conn.send((func(task), None))
+		except Exception as e:
+			conn.send((None, "%s: %s" % (type(e).__name__, e)))
+
+
+class SandboxWorker:
+	def __init__(self, func: Callable, initializer: Optional[Callable], initargs: tuple):
+		self.conn, child_conn = multiprocessing.Pipe()
+		self.process = multiprocessing.Process(target=worker_loop, args=(child_conn, func, initializer, initargs), daemon=True)
+		self.process.start()
+		child_conn.close()
+		# (index, task) being run
+		self.current = None
+
+	def stop(self):
+		try:
+			self.conn.send(None)
+		except (OSError, ValueError):
+			pass
+		self.process.join()
+		self.conn.close()
+
+
+class SandboxPool:
+	"""
+	Like multiprocessing.Pool.imap, but a worker that dies (segfault in a decoder, out of memory) doesn't take the
+	run down, or hang it like with Pool: its task is reported as failed, and a new worker takes its place.
+
+	Each worker runs one task at a time and is fed the next one as soon as it answers, so the overhead is a
+	round trip through a pipe per task.
+	"""
+	jobs: int
+
+	def __init__(self, jobs: int, func: Callable, initializer: Optional[Callable] = None, initargs: tuple = ()):
+		self.jobs = jobs
+		self.func = func
+		self.initializer = initializer
+		self.initargs = initargs
+		self.workers = []
+		self.crashes = 0
+
+	def __enter__(self):
+		self.workers = [self.start_worker() for _ in range(self.jobs)]
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		for worker in self.workers:
+			worker.stop()
+		self.workers = []
+		return False
+
+	def start_worker(self) -> SandboxWorker:
+		return SandboxWorker(self.func, self.initializer, self.initargs)
+
+	def imap(self, tasks: Iterable):
+		"""Yields (task, result, error) in the order of tasks. error is set when func raised, or its worker died"""
+		tasks = enumerate(tasks)
+		done = {}
+		next_index = 0
+		remaining = True
+		while True:
+			for worker in self.workers:
+				if worker.current is None and remaining:
+					try:
+						current = next(tasks)
+					except StopIteration:
+						remaining = False
+						break
+					self.submit(worker, current)
+			busy = [worker for worker in self.workers if worker.current is not None]
+			if len(busy) == 0:
+				break
+
+			ready = wait([worker.conn for worker in busy] + [worker.process.sentinel for worker in busy])
+			for worker in busy:
+				if worker.conn not in ready and worker.process.sentinel not in ready:
+					continue
+				index, task = worker.current
+				try:
+					# The answer can arrive just before the process exits, it still counts
+					result, error = worker.conn.recv() if worker.conn.poll() else self.replace(worker)
+				except (EOFError, OSError):
+					result, error = self.replace(worker)
+				worker.current = None
+				done[index] = (task, result, error)
+
+			while next_index in done:
+				yield done.pop(next_index)
+				next_index += 1
+
+	def submit(self, worker: SandboxWorker, current: tuple):
+		"""Sends (index, task) to worker. A worker that died while idle is replaced, and the task goes to the new one"""
+		try:
+			worker.conn.send(current[1])
+			worker.current = current
+			return
+		except (OSError, EOFError):
+			pass
+		# The task is not the one that crashed the worker, so it isn't reported as failed
+		worker = self.respawn(worker)
+		worker.current = current
+		try:
+			worker.conn.send(current[1])
+		except (OSError, EOFError):
+			# The new worker died too (eg in the initializer): its sentinel reports the task as crashed
+			pass
+
+	def replace(self, worker: SandboxWorker):
+		"""Swaps a dead worker for a new one, and returns the (result, error) of the task it was running"""
+		self.respawn(worker)
+		return None, "worker crashed (exit code %s)" % worker.process.exitcode
+
+	def respawn(self, worker: SandboxWorker) -> SandboxWorker:
+		worker.process.join()
+		worker.conn.close()
+		self.crashes += 1
+		new_worker = self.start_worker()
+		self.workers[self.workers.index(worker)] = new_worker
+		return new_worker
@@ -0,0 +1,58 @@
+"""Reading the m_Name of a MonoBehaviour from its header"""
+import struct
+
+import pytest
+
+pytest.importorskip("UnityPy")
+from asset_scanner import parse_mono_behaviour_name
+
+
+def mono_behaviour(name: bytes, endian: str = "<", version: int = 22, enabled: int = 1) -> bytes:
+	"""The serialized start of a MonoBehaviour, as found in the DBF assets and cards_map"""
+	path_id = "q" if version >= 14 else "i"
+	data = struct.pack(endian + "i" + path_id, 0, 0)  # m_GameObject
+	data += struct.pack(endian + "B", enabled) + b"\0\0\0"  # m_Enabled, aligned
+	data += struct.pack(endian + "i" + path_id, 1, 1234567890123 if version >= 14 else 12345)  # m_Script
+	data += struct.pack(endian + "i", len(name)) + name
+	data += b"\0" * (-len(data) % 4)
+	# The fields of the script (eg the DBF Records)
+	return data + struct.pack(endian + "i", 3) + b"\xff" * 12
+
+
+@pytest.mark.parametrize("endian", ["<", ">"])
+@pytest.mark.parametrize("version", [9, 13, 14, 22])
+def test_name(endian, version):
+	data = mono_behaviour(b"cards_map", endian, version)
+	assert parse_mono_behaviour_name(data, endian, version) == "cards_map"
+
+
+def test_dbf_name():
+	assert parse_mono_behaviour_name(mono_behaviour(b"CARD_SET")) == "CARD_SET"
+
+
+def test_empty_name():
+	# The MonoBehaviours of the prefabs have no name
+	assert parse_mono_behaviour_name(mono_behaviour(b"")) == ""
+
+
+def test_utf8_name():
+	assert parse_mono_behaviour_name(mono_behaviour("carte_é".encode("utf8"))) == "carte_é"
+
+
+def test_not_first_field():
+	# What obj.peek_name() reads: the m_FileID of m_GameObject, 0 for an asset
+	data = mono_behaviour(b"cards_map")
+	assert struct.unpack_from("<i", data, 0)[0] == 0
+	assert parse_mono_behaviour_name(data) == "cards_map"
+
+
+@pytest.mark.parametrize("data", [
+	b"",
+	b"\0" * 20,
+	# Negative length
+	b"\0" * 28 + struct.pack("<i", -1),
+	# Longer than the data
+	b"\0" * 28 + struct.pack("<i", 100) + b"abc",
+])
+def test_invalid(data):
+	assert parse_mono_behaviour_name(data) is None
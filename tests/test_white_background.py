@@ -0,0 +1,148 @@
+"""make_white_bg_transparent against the flood fill it replaced"""
+from collections import deque
+
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip("UnityPy")
+from generate_card_textures import label_white_regions, make_white_bg_transparent
+
+
+def flood_fill_white_bg_transparent(img, threshold=240):
+	"""The flood fill from the white border pixels that make_white_bg_transparent used to run"""
+	img = img.convert("RGBA")
+	w, h = img.size
+	pixels = img.load()
+	mask = set()
+
+	def is_white(px):
+		return px[0] >= threshold and px[1] >= threshold and px[2] >= threshold
+
+	queue = deque()
+	for x in range(w):
+		queue.append((x, 0))
+		queue.append((x, h - 1))
+	for y in range(h):
+		queue.append((0, y))
+		queue.append((w - 1, y))
+	while queue:
+		x, y = queue.popleft()
+		if 0 <= x < w and 0 <= y < h and (x, y) not in mask and is_white(pixels[x, y]):
+			mask.add((x, y))
+			for dx, dy in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
+				queue.append((x + dx, y + dy))
+
+	for x, y in mask:
+		r, g, b, a = pixels[x, y]
+		pixels[x, y] = (r, g, b, 0)
+	return img
+
+
+def bfs_labels(white):
+	"""The 4-connected regions of a boolean mask, as a set of frozensets of pixels"""
+	h, w = white.shape
+	seen = np.zeros_like(white)
+	regions = set()
+	for y0, x0 in zip(*np.nonzero(white)):
+		if seen[y0, x0]:
+			continue
+		region = []
+		queue = deque([(y0, x0)])
+		seen[y0, x0] = True
+		while queue:
+			y, x = queue.popleft()
+			region.append((y, x))
+			for ny, nx in [(y - 1, x), (y + 1, x), (y, x - 1), (y, x + 1)]:
+				if 0 <= ny < h and 0 <= nx < w and white[ny, nx] and not seen[ny, nx]:
+					seen[ny, nx] = True
+					queue.append((ny, nx))
+		regions.add(frozenset(region))
+	return regions
+
+
+def to_image(white):
+	"""White (250) where the mask is set, dark grey elsewhere, opaque"""
+	gray = np.where(white, 250, 40).astype(np.uint8)
+	return Image.fromarray(np.stack([gray, gray, gray, np.full_like(gray, 255)], axis = 2), "RGBA")
+
+
+def parse(rows):
+	return np.array([[c == "#" for c in row] for row in rows])
+
+
+SHAPES = {
+	# White outside a U, and inside it through its opening at the top
+	"u_shape": [
+		"##########",
+		"#.##..##.#",
+		"#.##..##.#",
+		"#.######.#",
+		"#........#",
+		"##########",
+	],
+	# A concave region whose pixels are only linked through a run far to the right, the case where
+	# hooking the roots on the smallest label takes several passes
+	"comb": [
+		"#.#.#.#.#.#...",
+		"#.#.#.#.#.#.#.",
+		"#.#.#.#.#.#.#.",
+		"#############.",
+		"..............",
+	],
+	"spiral": [
+		"###########",
+		"#.........#",
+		"#.#######.#",
+		"#.#.....#.#",
+		"#.#.###.#.#",
+		"#.#.#.#.#.#",
+		"#.#.#...#.#",
+		"#.#.#####.#",
+		"#.#.......#",
+		"#.#########",
+	],
+	# Enclosed white regions that must stay opaque, and regions touching each border
+	"enclosed": [
+		"#..####..#",
+		"#.#....#.#",
+		"##.####.##",
+		"#.#.##.#.#",
+		"..#....#..",
+		"#..####..#",
+	],
+	"all_white": ["####", "####"],
+	"no_white": ["....", "...."],
+	"single_pixel": ["#"],
+	"single_row": ["##.#.##"],
+	"single_column": ["#", ".", "#", "#"],
+}
+
+
+@pytest.mark.parametrize("name", sorted(SHAPES))
+def test_shapes(name):
+	white = parse(SHAPES[name])
+	img = to_image(white)
+	expected = np.array(flood_fill_white_bg_transparent(img))
+	assert (np.array(make_white_bg_transparent(img)) == expected).all()
+	assert label_partition(white) == bfs_labels(white)
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_random(seed):
+	rng = np.random.default_rng(seed)
+	h, w = rng.integers(1, 60), rng.integers(1, 120)
+	white = rng.random((h, w)) < rng.uniform(0.3, 0.8)
+	img = to_image(white)
+	expected = np.array(flood_fill_white_bg_transparent(img))
+	assert (np.array(make_white_bg_transparent(img)) == expected).all()
+	assert label_partition(white) == bfs_labels(white)
+
+
+def label_partition(white):
+	labels = label_white_regions(white)
+	regions = {}
+	for y, x in zip(*np.nonzero(white)):
+		regions.setdefault(labels[y, x], []).append((y, x))
+	assert 0 not in regions
+	return {frozenset(region) for region in regions.values()}